@@ -1,14 +1,36 @@
 import base64
 import json
+import logging
 
+import django
 from django import forms
+from django.conf import settings
 from django.contrib import admin
 
-from drip.models import Drip, SentDrip, QuerySetRule
+from drip.models import Drip, SentDrip, DripOutbox, QuerySetRule
 from drip.drips import configured_message_classes, message_class_for
 from drip.utils import get_user_model
 
 
+def get_preview_cache():
+    alias = getattr(settings, 'DRIP_PREVIEW_CACHE', 'default')
+    try:
+        from django.core.cache import caches
+    except ImportError:
+        # handle 1.6 and back
+        from django.core.cache import get_cache
+        return get_cache(alias)
+    return caches[alias]
+
+
+def preview_cache_key(drip, user_id):
+    """
+    Editing the drip changes its lastchanged, and so the key of every
+    preview rendered before.
+    """
+    return 'drip:preview:%s:%s:%s' % (drip.id, drip.lastchanged.strftime('%Y%m%d%H%M%S%f'), user_id)
+
+
 class QuerySetRuleInline(admin.TabularInline):
     model = QuerySetRule
 
@@ -33,31 +55,82 @@ class DripAdmin(admin.ModelAdmin):
     def timeline(self, request, drip_id, into_past, into_future):
         """
         Return a list of people who should get emails.
+
+        Shows how many users get the drip each day, with the first page
+        of them inline; the rest are loaded from timeline_users.
         """
         from django.shortcuts import render, get_object_or_404
 
         drip = get_object_or_404(Drip, id=drip_id)
+        page_size = getattr(settings, 'DRIP_TIMELINE_PAGE_SIZE', 100)
+
+        drip_base = drip.drip
+        walked = drip_base.walk(into_past=int(into_past), into_future=int(into_future)+1)
+        first_days = drip_base.first_days(walked)
+        counts = drip_base.first_day_counts(first_days, len(walked))
+
+        users_by_day = [[] for shifted_drip in walked]
+        first_page = drip_base.first_day_users(first_days, limit=page_size)
+        for user in first_page:
+            users_by_day[user.drip_day].append(user)
+        self.prerender_previews(drip, first_page[:getattr(settings, 'DRIP_PREVIEW_PRERENDER', 20)])
 
         shifted_drips = []
-        seen_users = set()
-        for shifted_drip in drip.drip.walk(into_past=int(into_past), into_future=int(into_future)+1):
-            shifted_drip.prune()
+        for day, (shifted_drip, users, count) in enumerate(zip(walked, users_by_day, counts)):
             shifted_drips.append({
                 'drip': shifted_drip,
-                'qs': shifted_drip.get_queryset().exclude(id__in=seen_users)
+                'day': day,
+                'count': count,
+                'qs': users,
+                'after': users[-1].pk if users else '',
+                'more': count > len(users),
             })
-            seen_users.update(shifted_drip.get_queryset().values_list('id', flat=True))
 
         return render(request, 'drip/timeline.html', locals())
 
-    def view_drip_email(self, request, drip_id, into_past, into_future, user_id):
-        from django.shortcuts import render, get_object_or_404
-        from django.http import HttpResponse
+    def timeline_users(self, request, drip_id, into_past, into_future):
+        """
+        Return a page of the users first getting the drip on the `day`
+        (an index into the timeline) in the query string, as JSON.
+
+        Pages are keyed on primary key: pass the `next` of a page as
+        `after` to get the one following it.
+        """
+        from django.shortcuts import get_object_or_404
+        from django.core.urlresolvers import reverse
+        from django.http import HttpResponse, HttpResponseBadRequest
+
         drip = get_object_or_404(Drip, id=drip_id)
-        User = get_user_model()
-        user = get_object_or_404(User, id=user_id)
+        page_size = getattr(settings, 'DRIP_TIMELINE_PAGE_SIZE', 100)
+        try:
+            day = int(request.GET['day'])
+            after = int(request.GET['after']) if request.GET.get('after') else None
+            limit = min(int(request.GET.get('limit', page_size)), page_size)
+        except (KeyError, ValueError):
+            return HttpResponseBadRequest('day, after and limit must be integers.')
+        if limit < 1:
+            return HttpResponseBadRequest('limit must be at least 1.')
+
+        drip_base = drip.drip
+        walked = drip_base.walk(into_past=int(into_past), into_future=int(into_future)+1)
+        users = drip_base.first_day_users(drip_base.first_days(walked), day=day, after=after, limit=limit)
 
-        drip_message = message_class_for(drip.message_class)(drip.drip, user)
+        data = {
+            'users': [{
+                'id': user.pk,
+                'email': user.email,
+                'url': reverse('admin:view_drip_email', kwargs={
+                    'drip_id': drip.id, 'into_past': into_past, 'into_future': into_future, 'user_id': user.pk}),
+            } for user in users],
+            'next': users[-1].pk if users and len(users) == limit else None,
+        }
+        return HttpResponse(json.dumps(data), content_type='application/json')
+
+    def render_preview(self, drip_base, user):
+        """
+        Returns (body, mime type) of the email the user would get.
+        """
+        drip_message = message_class_for(drip_base.drip_model.message_class)(drip_base, user)
         html = ''
         mime = ''
         if drip_message.message.alternatives:
@@ -68,14 +141,66 @@ class DripAdmin(admin.ModelAdmin):
         else:
             html = drip_message.message.body
             mime = 'text/plain'
+        return html, mime
 
+    def prerender_previews(self, drip, users):
+        """
+        Render and cache the previews of any of the users not cached yet.
+        """
+        cache = get_preview_cache()
+        keys = dict((preview_cache_key(drip, user.pk), user) for user in users)
+        missing = set(keys) - set(cache.get_many(list(keys)))
+        if not missing:
+            return
+
+        drip_base = drip.drip
+        previews = {}
+        for key in missing:
+            try:
+                previews[key] = self.render_preview(drip_base, keys[key])
+            except Exception as e:
+                logging.error("Failed to render drip %s preview for user %s: %s" % (drip.id, keys[key], e))
+        cache.set_many(previews, getattr(settings, 'DRIP_PREVIEW_CACHE_TIMEOUT', 3600))
+
+    def view_drip_email(self, request, drip_id, into_past, into_future, user_id):
+        from django.shortcuts import get_object_or_404
+        from django.http import HttpResponse
+        drip = get_object_or_404(Drip, id=drip_id)
+
+        cache = get_preview_cache()
+        key = preview_cache_key(drip, user_id)
+        preview = cache.get(key)
+        if preview is None:
+            User = get_user_model()
+            user = get_object_or_404(User, id=user_id)
+            preview = self.render_preview(drip.drip, user)
+            cache.set(key, preview, getattr(settings, 'DRIP_PREVIEW_CACHE_TIMEOUT', 3600))
+
+        html, mime = preview
         return HttpResponse(html, content_type=mime)
 
+    def field_search(self, request):
+        """
+        Return the user fields with any part of their name starting with
+        `q`, as JSON [full field name, field class name] pairs.
+        """
+        from django.http import HttpResponse, HttpResponseBadRequest
+        from drip.utils import get_field_index
+
+        try:
+            limit = int(request.GET.get('limit', 50))
+        except ValueError:
+            return HttpResponseBadRequest('limit must be an integer.')
+        if limit < 1:
+            return HttpResponseBadRequest('limit must be at least 1.')
+
+        fields = get_field_index(get_user_model()).search(request.GET.get('q', ''), limit=limit)
+        return HttpResponse(json.dumps(fields), content_type='application/json')
+
     def build_extra_context(self, extra_context):
-        from drip.utils import get_simple_fields
+        from django.core.urlresolvers import reverse
         extra_context = extra_context or {}
-        User = get_user_model()
-        extra_context['field_data'] = json.dumps(get_simple_fields(User))
+        extra_context['field_search_url'] = reverse('admin:drip_field_search')
         return extra_context
 
     def add_view(self, request, extra_context=None):
@@ -90,11 +215,21 @@ class DripAdmin(admin.ModelAdmin):
         from django.conf.urls import patterns, url
         urls = super(DripAdmin, self).get_urls()
         my_urls = patterns('',
+            url(
+                r'^fields/$',
+                self.av(self.field_search),
+                name='drip_field_search'
+            ),
             url(
                 r'^(?P<drip_id>[\d]+)/timeline/(?P<into_past>[\d]+)/(?P<into_future>[\d]+)/$',
                 self.av(self.timeline),
                 name='drip_timeline'
             ),
+            url(
+                r'^(?P<drip_id>[\d]+)/timeline/(?P<into_past>[\d]+)/(?P<into_future>[\d]+)/users/$',
+                self.av(self.timeline_users),
+                name='drip_timeline_users'
+            ),
             url(
                 r'^(?P<drip_id>[\d]+)/timeline/(?P<into_past>[\d]+)/(?P<into_future>[\d]+)/(?P<user_id>[\d]+)/$',
                 self.av(self.view_drip_email),
@@ -104,8 +239,24 @@ class DripAdmin(admin.ModelAdmin):
         return my_urls + urls
 admin.site.register(Drip, DripAdmin)
 
+if getattr(settings, 'DRIP_WARM_FIELD_CACHE', False):
+    from drip.utils import get_field_index
+    get_field_index(get_user_model())
+
 
 class SentDripAdmin(admin.ModelAdmin):
-    list_display = [f.name for f in SentDrip._meta.fields]
+    list_display = [f.name for f in SentDrip._meta.fields if f.name not in ('subject_content', 'body_content')]
+    # Django < 1.6 only takes a boolean, following just the non-null keys
+    if django.VERSION >= (1, 6):
+        list_select_related = ('drip', 'user', 'subject_content', 'body_content')
+    else:
+        list_select_related = True
     ordering = ['-id']
 admin.site.register(SentDrip, SentDripAdmin)
+
+
+class DripOutboxAdmin(admin.ModelAdmin):
+    list_display = ('id', 'date', 'drip', 'user', 'subject', 'claimed_by', 'claimed_at', 'attempts', 'sent_at')
+    list_filter = ('drip',)
+    ordering = ['id']
+admin.site.register(DripOutbox, DripOutboxAdmin)
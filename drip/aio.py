@@ -0,0 +1,220 @@
+"""
+An asyncio delivery engine, for Python 3.5 and up.
+
+`AsyncDelivery` is a drop in replacement for the deliveries in
+`drip.delivery`: `DripBase.send()` still renders and records in batches,
+while each batch is sent from a single event loop with a bounded number
+of sends in flight.
+"""
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from importlib import import_module
+
+from django.conf import settings
+from django.core import mail
+from django.core.mail import get_connection, EmailMessage
+
+
+class AsyncBackend(object):
+    """
+    The interface for asynchronous email backends.
+    """
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def send_messages(self, messages):
+        """
+        Send the messages, returning how many were sent.
+        """
+        raise NotImplementedError
+
+
+class ExecutorBackend(AsyncBackend):
+    """
+    Adapts the configured (blocking) Django email backend by running it
+    in a thread pool, one connection per thread.
+    """
+
+    def __init__(self, max_workers=10):
+        self.max_workers = max_workers
+        self._local = threading.local()
+        self._connections = []
+        self._executor = None
+
+    async def open(self):
+        self._executor = ThreadPoolExecutor(self.max_workers)
+
+    async def close(self):
+        self._executor.shutdown(wait=True)
+        for connection in self._connections:
+            connection.close()
+        self._connections = []
+
+    def _send_messages(self, messages):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = get_connection()
+            self._connections.append(connection)
+            connection.open()
+        return connection.send_messages(messages)
+
+    async def send_messages(self, messages):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, self._send_messages, messages)
+
+
+class LocmemAsyncBackend(AsyncBackend):
+    """
+    An in-process stand-in for an asynchronous SMTP relay, for tests.
+
+    Each send waits `latency` seconds before landing in
+    `django.core.mail.outbox`, and messages to any address in `fail_for`
+    are refused. `max_in_flight` records the most sends seen at once.
+    """
+
+    def __init__(self, latency=0, fail_for=()):
+        self.latency = latency
+        self.fail_for = set(fail_for)
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def send_messages(self, messages):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+            sent = [message for message in messages
+                    if not self.fail_for.intersection(message.recipients())]
+            if not hasattr(mail, 'outbox'):
+                mail.outbox = []
+            mail.outbox.extend(sent)
+            return len(sent)
+        finally:
+            self.in_flight -= 1
+
+
+class AsyncDelivery(object):
+    """
+    Delivers messages from one event loop with at most `concurrency`
+    sends in flight.
+
+    Messages are fed to the senders through a queue of `queue_size`,
+    so a slow backend holds up the producer instead of piling up
+    pending sends. With a `controller` (see
+    `drip.delivery.AIMDController`) senders also hold back whenever its
+    limit of sends are already in flight.
+    """
+
+    def __init__(self, backend=None, concurrency=100, queue_size=None, controller=None):
+        if backend is None:
+            backend = get_async_backend(concurrency)
+        self.backend = backend
+        self.concurrency = concurrency
+        self.controller = controller
+        self.queue_size = queue_size or concurrency
+        self.loop = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open(self):
+        self.loop = asyncio.new_event_loop()
+        self.loop.run_until_complete(self.backend.open())
+
+    def close(self):
+        if self.loop is not None:
+            self.loop.run_until_complete(self.backend.close())
+            self.loop.close()
+            self.loop = None
+
+    async def send_message(self, message):
+        if isinstance(message, EmailMessage):
+            return await self.backend.send_messages([message])
+
+        # custom message classes only promise a blocking `send` method
+        return await asyncio.get_event_loop().run_in_executor(None, message.send)
+
+    async def deliver_one(self, message_instance):
+        try:
+            return await self.send_message(message_instance.message)
+        except Exception as e:
+            logging.error("Failed to send drip %s to user %s: %s" % (
+                message_instance.drip_base.drip_model.id, message_instance.user, e))
+            return False
+
+    async def deliver_async(self, message_instances):
+        results = [False] * len(message_instances)
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        slots = asyncio.Condition()
+        in_flight = [0]
+
+        async def deliver_controlled(message_instance):
+            if self.controller is None:
+                return await self.deliver_one(message_instance)
+
+            async with slots:
+                await slots.wait_for(lambda: in_flight[0] < self.controller.limit)
+                in_flight[0] += 1
+
+            started = time.time()
+            result = await self.deliver_one(message_instance)
+
+            async with slots:
+                in_flight[0] -= 1
+                self.controller.record(time.time() - started, bool(result))
+                slots.notify_all()
+            return result
+
+        async def sender():
+            while True:
+                task = await queue.get()
+                try:
+                    if task is None:
+                        return
+                    index, message_instance = task
+                    results[index] = await deliver_controlled(message_instance)
+                finally:
+                    queue.task_done()
+
+        senders = [asyncio.ensure_future(sender())
+                   for i in range(min(self.concurrency, len(message_instances)))]
+        for task in enumerate(message_instances):
+            await queue.put(task)
+        for s in senders:
+            await queue.put(None)
+        await asyncio.gather(*senders)
+        return results
+
+    def deliver(self, message_instances):
+        """
+        Send the message of each rendered DripMessage, returning
+        a list of results in the same order.
+        """
+        return self.loop.run_until_complete(self.deliver_async(message_instances))
+
+
+def get_async_backend(concurrency=None):
+    """
+    Returns the backend named by `DRIP_ASYNC_EMAIL_BACKEND`, by default
+    the configured Django backend run in a thread pool.
+
+    An `ExecutorBackend` gets a thread for each of the `concurrency`
+    sends in flight, so the pool never caps the delivery.
+    """
+    path = getattr(settings, 'DRIP_ASYNC_EMAIL_BACKEND', 'drip.aio.ExecutorBackend')
+    mod_name, klass_name = path.rsplit('.', 1)
+    klass = getattr(import_module(mod_name), klass_name)
+    if concurrency and issubclass(klass, ExecutorBackend):
+        return klass(max_workers=concurrency)
+    return klass()
@@ -0,0 +1,286 @@
+"""
+Timing drip runs: stage by stage without sending or recording anything,
+and end to end against a synthetic population of users.
+"""
+import logging
+import re
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import Group
+from django.core import mail
+from django.core.mail import get_connection, EmailMessage
+from django.db import connections
+
+from drip.delivery import SerialDelivery
+from drip.drips import message_class_for, conditional_now
+from drip.models import Drip, SentDrip, QuerySetRule
+from drip.utils import get_user_model
+
+STAGES = ('query', 'prune', 'render', 'strip_tags', 'message', 'send', 'record')
+
+
+class StageTimer(object):
+    """
+    Accumulates wall time spent in each named stage.
+    """
+
+    def __init__(self):
+        self.timings = OrderedDict((stage, 0.0) for stage in STAGES)
+
+    @contextmanager
+    def stage(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.time() - started
+
+    @property
+    def total(self):
+        return sum(self.timings.values())
+
+
+def benchmark_drip(drip_base):
+    """
+    Push a drip through selection, prune, rendering and MIME building,
+    delivering to a no-op backend and building (but never saving) its
+    SentDrips. Messages the backend can't take are never sent.
+
+    Returns a dict with the candidate and audience sizes, the per-stage
+    timings and messages per second.
+    """
+    timer = StageTimer()
+    if not drip_base.from_email:
+        drip_base.from_email = getattr(settings, 'DRIP_FROM_EMAIL', settings.DEFAULT_FROM_EMAIL)
+    MessageClass = message_class_for(drip_base.drip_model.message_class)
+
+    started = time.time()
+    candidates = drip_base.get_queryset().count()
+    query_seconds = time.time() - started
+    timer.timings['query'] += query_seconds
+
+    # prune() only adds a NOT EXISTS to the queryset, book what that adds to counting it
+    drip_base.prune()
+    started = time.time()
+    drip_base.get_queryset().count()
+    timer.timings['prune'] += max(time.time() - started - query_seconds, 0.0)
+
+    audience = 0
+    delivery = SerialDelivery(get_connection('django.core.mail.backends.dummy.EmailBackend'), dry_run=True)
+    with delivery:
+        batches = drip_base.iter_user_batches()
+        while True:
+            with timer.stage('query'):
+                users = next(batches, None)
+            if users is None:
+                break
+
+            message_instances = []
+            for user in users:
+                message_instance = MessageClass(drip_base, user)
+                try:
+                    with timer.stage('render'):
+                        message_instance.subject
+                        message_instance.body
+                    with timer.stage('strip_tags'):
+                        message_instance.plain
+                    with timer.stage('message'):
+                        message = message_instance.message
+                        if isinstance(message, EmailMessage):
+                            message.message()
+                except Exception as e:
+                    logging.error("Failed to render drip %s for user %s: %s" % (drip_base.drip_model.id, user, e))
+                    continue
+                message_instances.append(message_instance)
+
+            with timer.stage('send'):
+                results = delivery.deliver(message_instances)
+            with timer.stage('record'):
+                for message_instance, result in zip(message_instances, results):
+                    if result:
+                        drip_base.build_sent_drip(message_instance.user, message_instance)
+                        audience += 1
+
+    return {
+        'drip': drip_base.drip_model,
+        'candidates': candidates,
+        'audience': audience,
+        'timings': timer.timings,
+        'total': timer.total,
+        'rate': audience / timer.total if timer.total else 0.0,
+    }
+
+
+def format_benchmark(result):
+    lines = ['Drip %s (%s): %d candidates, %d to send, %.3fs, %.1f messages/s' % (
+        result['drip'].id, result['drip'].name, result['candidates'], result['audience'],
+        result['total'], result['rate'])]
+    lines.append('  ' + '  '.join('%s %.3fs' % (stage, seconds)
+                                  for stage, seconds in result['timings'].items()))
+    return '\n'.join(lines)
+
+
+#######################
+### SYNTHETIC SCALE ###
+#######################
+
+BENCHMARK_BODY = """<h1>Hi {{ user.username }}!</h1>
+<p>You joined on {{ user.date_joined|date:"N j, Y" }}, here is what you missed:</p>
+<ul>{% for i in "12345" %}<li>Tip number {{ i }} for <b>{{ user.email }}</b></li>{% endfor %}</ul>"""
+
+
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def generate_fixture(users=100000, history=0.5, history_drips=3, groups=5, batch_size=5000):
+    """
+    Bulk create a synthetic population of `users` users who joined over
+    the last 60 days, each in one of `groups` groups, plus an enabled
+    benchmark drip for users who joined one to three weeks ago.
+
+    The benchmark drip and `history_drips` other drips each get SentDrip
+    history for a `history` fraction of the users.
+
+    Returns the benchmark Drip.
+    """
+    User = get_user_model()
+    username_field = getattr(User, 'USERNAME_FIELD', 'username')
+    now = conditional_now()
+
+    for batch in chunked(range(users), batch_size):
+        User.objects.bulk_create([
+            User(**{username_field: 'drip_benchmark_%d' % i,
+                    'email': 'drip_benchmark_%d@example.com' % i,
+                    'date_joined': now - timedelta(minutes=(i * 60 * 24 * 60) // users)})
+            for i in batch])
+    user_ids = list(User.objects.filter(**{'%s__startswith' % username_field: 'drip_benchmark_'})
+                                .order_by('pk').values_list('pk', flat=True))
+
+    if groups and hasattr(User, 'groups'):
+        group_ids = [Group.objects.create(name='Drip Benchmark %d' % i).pk for i in range(groups)]
+        Membership = User.groups.through
+        for batch in chunked(user_ids, batch_size):
+            Membership.objects.bulk_create([
+                Membership(user_id=user_id, group_id=group_ids[user_id % groups]) for user_id in batch])
+
+    drip = Drip.objects.create(
+        name='Drip Benchmark',
+        enabled=True,
+        subject_template='Hey {{ user.username }}, one week in!',
+        body_html_template=BENCHMARK_BODY)
+    QuerySetRule.objects.create(drip=drip, field_name='date_joined', lookup_type='lt', field_value='now-7 days')
+    QuerySetRule.objects.create(drip=drip, field_name='date_joined', lookup_type='gte', field_value='now-21 days')
+
+    drips = [drip] + [Drip.objects.create(name='Drip Benchmark History %d' % i) for i in range(history_drips)]
+    every = int(1 / history) if history else 0
+    for history_drip in drips:
+        if not every:
+            break
+        for batch in chunked(user_ids[::every], batch_size):
+            SentDrip.objects.bulk_create([
+                SentDrip(drip=history_drip, user_id=user_id, subject='Old news', body='Sent a while ago.')
+                for user_id in batch])
+
+    return drip
+
+
+@contextmanager
+def count_queries(counts, using='default'):
+    """
+    Append the number of queries run inside the block to `counts`.
+    """
+    connection = connections[using]
+    old_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    start = len(connection.queries)
+    try:
+        yield
+    finally:
+        counts.append(len(connection.queries) - start)
+        connection.use_debug_cursor = old_debug_cursor
+
+
+def measure(results, stage, func):
+    """
+    Time func(), which returns how many items it handled, and record it
+    with its query count in `results`.
+    """
+    counts = []
+    started = time.time()
+    with count_queries(counts):
+        items = func()
+    seconds = time.time() - started
+    results.append({
+        'stage': stage,
+        'seconds': seconds,
+        'queries': counts[0],
+        'items': items,
+        'rate': items / seconds if seconds else 0.0,
+    })
+
+
+def timeline_view(drip, into_past, into_future):
+    from django.core.urlresolvers import resolve, reverse
+    from django.test.client import RequestFactory
+
+    url = reverse('admin:drip_timeline', kwargs={
+        'drip_id': drip.id, 'into_past': into_past, 'into_future': into_future})
+    request = RequestFactory().get(url)
+    # an unsaved superuser, so it doesn't show up in any audience
+    request.user = get_user_model()(is_staff=True, is_superuser=True, is_active=True)
+    match = resolve(url)
+    return match.func(request, *match.args, **match.kwargs)
+
+
+def run_scale_benchmark(drip, into_past=3, into_future=7):
+    """
+    Time prune(), walk(), the admin timeline and a full run() of the
+    drip against the locmem email backend.
+
+    Returns a list of dicts with each stage's seconds, query count,
+    items handled and items per second.
+    """
+    results = []
+
+    def prune():
+        drip_base = drip.drip
+        drip_base.prune()
+        return drip_base.get_queryset().count()
+    measure(results, 'prune', prune)
+
+    def walk():
+        walked = 0
+        for shifted_drip in drip.drip.walk(into_past=into_past, into_future=into_future + 1):
+            shifted_drip.prune()
+            walked += shifted_drip.get_queryset().count()
+        return walked
+    measure(results, 'walk', walk)
+
+    def timeline():
+        response = timeline_view(drip, into_past, into_future)
+        # each day's full count, not just the users listed on its first page
+        return sum(int(count) for count in re.findall(br'\((\d+) users?\)', response.content))
+    measure(results, 'timeline', timeline)
+
+    old_backend = settings.EMAIL_BACKEND
+    settings.EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+    mail.outbox = []
+    try:
+        measure(results, 'run', lambda: drip.drip.run() or 0)
+    finally:
+        settings.EMAIL_BACKEND = old_backend
+        mail.outbox = []
+
+    return results
+
+
+def format_scale_benchmark(results):
+    return '\n'.join('%-8s %9.3fs %7d queries %9d items %11.1f items/s' % (
+        result['stage'], result['seconds'], result['queries'], result['items'], result['rate'])
+        for result in results)
@@ -0,0 +1,246 @@
+"""
+Delivery of rendered drip messages through the configured email backend.
+"""
+import logging
+import smtplib
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from django.conf import settings
+from django.core.mail import get_connection, EmailMessage
+
+
+class AIMDController(object):
+    """
+    Additive-increase, multiplicative-decrease control of how many sends
+    may be in flight against one backend.
+
+    Every send reports its latency and outcome. While sends succeed
+    within `target_latency` the limit grows by about `increase` per full
+    window of sends; a failed or slow send cuts it by `decrease`, at most
+    once per `target_latency` so one burst of refusals counts as a
+    single congestion event.
+    """
+
+    def __init__(self, maximum, minimum=1, initial=None, target_latency=1.0,
+                 increase=1.0, decrease=0.5, clock=time.time):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.target_latency = target_latency
+        self.increase = increase
+        self.decrease = decrease
+        self.clock = clock
+        self.window = float(initial or min(4, maximum))
+        self.last_decrease = None
+
+    @property
+    def limit(self):
+        return max(self.minimum, int(self.window))
+
+    def record(self, latency, ok):
+        if ok and latency <= self.target_latency:
+            self.window = min(self.maximum, self.window + self.increase / self.window)
+            return
+
+        now = self.clock()
+        if self.last_decrease is None or now - self.last_decrease >= self.target_latency:
+            self.last_decrease = now
+            self.window = max(self.minimum, self.window * self.decrease)
+            logging.info("Drip delivery backing off to %d concurrent sends" % self.limit)
+
+
+def get_controller(maximum):
+    """
+    Returns an AIMDController for up to `maximum` concurrent sends if
+    `DRIP_SEND_ADAPTIVE` is set: True for the defaults, or a dict of
+    AIMDController keyword arguments.
+    """
+    adaptive = getattr(settings, 'DRIP_SEND_ADAPTIVE', False)
+    if not adaptive:
+        return None
+    kwargs = adaptive if isinstance(adaptive, dict) else {}
+    return AIMDController(maximum, **kwargs)
+
+
+class SerialDelivery(object):
+    """
+    Delivers messages one after another over a single backend connection.
+
+    The connection is opened once and shared by every message (and every
+    drip) handed to `deliver`, instead of each `message.send()` opening
+    and closing its own.
+
+    With `dry_run`, messages that aren't EmailMessages (and so can't go
+    through the connection) count as sent without being sent.
+    """
+    dry_run = False
+
+    def __init__(self, connection=None, dry_run=False):
+        self.connection = connection
+        self.dry_run = dry_run
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open(self):
+        if self.connection is None:
+            self.connection = get_connection()
+        self.connection.open()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+    def send_message(self, message, connection):
+        """
+        Send a single message over the connection, returning a truthy
+        value if it was sent.
+        """
+        if connection is not None and isinstance(message, EmailMessage):
+            try:
+                return connection.send_messages([message])
+            except smtplib.SMTPServerDisconnected:
+                # the relay dropped an idle connection, reconnect once
+                connection.close()
+                connection.open()
+                return connection.send_messages([message])
+
+        if self.dry_run:
+            return True
+        # custom message classes only promise a `send` method
+        return message.send()
+
+    def deliver_one(self, message_instance, connection):
+        try:
+            return self.send_message(message_instance.message, connection)
+        except Exception as e:
+            logging.error("Failed to send drip %s to user %s: %s" % (
+                message_instance.drip_base.drip_model.id, message_instance.user, e))
+            return False
+
+    def deliver(self, message_instances):
+        """
+        Send the message of each rendered DripMessage, returning
+        a list of results in the same order.
+        """
+        return [self.deliver_one(message_instance, self.connection)
+                for message_instance in message_instances]
+
+
+class ThreadedDelivery(SerialDelivery):
+    """
+    Delivers messages concurrently from a pool of worker threads.
+
+    Each worker opens its own backend connection and keeps it for as
+    long as the delivery is open. Messages must already be rendered,
+    workers only send them and never touch the database.
+
+    With a `controller` (see AIMDController) workers hold back whenever
+    its limit of sends are already in flight.
+    """
+
+    def __init__(self, workers, controller=None):
+        super(ThreadedDelivery, self).__init__()
+        self.workers = workers
+        self.controller = controller
+        self.in_flight = 0
+        self._tasks = queue.Queue()
+        self._threads = []
+        self._slots = threading.Condition()
+
+    def open(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name='drip-delivery-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def close(self):
+        for thread in self._threads:
+            self._tasks.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _work(self):
+        connection = get_connection()
+        try:
+            connection.open()
+        except Exception as e:
+            # each send will retry opening and log its own failure
+            logging.error("Failed to open email connection: %s" % e)
+
+        while True:
+            task = self._tasks.get()
+            try:
+                if task is None:
+                    break
+                index, message_instance, results = task
+                results[index] = self.deliver_controlled(message_instance, connection)
+            finally:
+                self._tasks.task_done()
+
+        connection.close()
+
+    def deliver_controlled(self, message_instance, connection):
+        if self.controller is None:
+            return self.deliver_one(message_instance, connection)
+
+        with self._slots:
+            while self.in_flight >= self.controller.limit:
+                self._slots.wait()
+            self.in_flight += 1
+
+        started = time.time()
+        result = self.deliver_one(message_instance, connection)
+
+        with self._slots:
+            self.in_flight -= 1
+            self.controller.record(time.time() - started, bool(result))
+            self._slots.notify_all()
+        return result
+
+    def deliver(self, message_instances):
+        if not self._threads:
+            # nothing would ever take the tasks off the queue
+            raise RuntimeError('ThreadedDelivery must be opened before delivering.')
+        results = [False] * len(message_instances)
+        for index, message_instance in enumerate(message_instances):
+            self._tasks.put((index, message_instance, results))
+        self._tasks.join()
+        return results
+
+
+def get_delivery(connection=None, workers=None, engine=None):
+    """
+    Returns an unopened delivery for the configured email backend,
+    threaded if more than one worker is asked for (or configured with
+    `DRIP_SEND_WORKERS`).
+
+    With the 'asyncio' engine (or `DRIP_SEND_ENGINE`), messages go out
+    from an event loop instead, `workers` being the sends kept in flight.
+
+    Concurrent deliveries adapt to the backend when `DRIP_SEND_ADAPTIVE`
+    is set, see `get_controller`.
+    """
+    if engine is None:
+        engine = getattr(settings, 'DRIP_SEND_ENGINE', 'threads')
+    if engine == 'asyncio':
+        from drip.aio import AsyncDelivery
+        concurrency = workers or getattr(settings, 'DRIP_SEND_CONCURRENCY', 100)
+        return AsyncDelivery(concurrency=concurrency, controller=get_controller(concurrency))
+
+    if workers is None:
+        workers = getattr(settings, 'DRIP_SEND_WORKERS', 1)
+    if workers > 1:
+        return ThreadedDelivery(workers, controller=get_controller(workers))
+    return SerialDelivery(connection=connection)
@@ -1,14 +1,19 @@
 import operator
 import functools
+import time
+from contextlib import contextmanager
 
 from django.conf import settings
+from django.db import connections, IntegrityError
 from django.db.models import Q
-from django.template import Context, Template
+from django.template import Context
 from django.utils.importlib import import_module
 from django.core.mail import EmailMultiAlternatives
-from django.utils.html import strip_tags
 
-from drip.models import SentDrip
+from drip.models import SentDrip, SentDripContent, DripOutbox
+from drip.delivery import get_delivery
+from drip.instrumentation import get_instrumentation
+from drip.rendering import compile_template, has_tags, html_to_text
 from drip.utils import get_user_model
 
 try:
@@ -17,6 +22,12 @@ except ImportError:
     from datetime import datetime
     conditional_now = datetime.now
 
+# handle 1.6 and back
+try:
+    from django.db.transaction import atomic
+except ImportError:
+    from django.db.transaction import commit_on_success as atomic
+
 
 import logging
 
@@ -37,6 +48,37 @@ def message_class_for(name):
 
 
 class DripMessage(object):
+    __slots__ = ('drip_base', 'user', '_context', '_subject', '_body', '_plain', '_message')
+
+    @classmethod
+    def render_many(cls, drip_base, users):
+        """
+        Returns a message for each user with its subject, body and plain
+        text rendered, sharing one context (unless the class builds its
+        own `context`) and the drip's compiled templates between them.
+        Users whose message fails to render are logged and skipped.
+        """
+        share_context = cls.context is DripMessage.context
+        context = Context()
+        message_instances = []
+        for user in users:
+            message_instance = cls(drip_base, user)
+            if share_context:
+                message_instance._context = context
+                context.update({'user': user})
+            try:
+                message_instance.subject
+                message_instance.body
+                message_instance.plain
+            except Exception as e:
+                logging.error("Failed to render drip %s for user %s: %s" % (drip_base.drip_model.id, user, e))
+                continue
+            finally:
+                if share_context:
+                    context.pop()
+                    message_instance._context = None
+            message_instances.append(message_instance)
+        return message_instances
 
     def __init__(self, drip_base, user):
         self.drip_base = drip_base
@@ -64,19 +106,22 @@ class DripMessage(object):
     @property
     def subject(self):
         if not self._subject:
-            self._subject = Template(self.drip_base.subject_template).render(self.context)
+            self._subject = self.drip_base.get_subject_template().render(self.context)
         return self._subject
 
     @property
     def body(self):
         if not self._body:
-            self._body = Template(self.drip_base.body_template).render(self.context)
+            self._body = self.drip_base.get_body_template().render(self.context)
         return self._body
 
     @property
     def plain(self):
         if not self._plain:
-            self._plain = strip_tags(self.body)
+            if has_tags(self.body):
+                self._plain = html_to_text(self.body)
+            else:
+                self._plain = self.body
         return self._plain
 
     @property
@@ -90,8 +135,8 @@ class DripMessage(object):
             self._message = EmailMultiAlternatives(
                 self.subject, self.plain, from_, [self.user.email])
 
-            # check if there are html tags in the rendered template
-            if len(self.plain) != len(self.body):
+            # plain is the body itself unless has_tags() found html in it
+            if self.plain is not self.body:
                 self._message.attach_alternative(self.body, 'text/html')
         return self._message
 
@@ -109,6 +154,22 @@ class DripBase(object):
     body_template = None
     from_email = None
     from_email_name = None
+    #: "django", "jinja2" or an engine class path, None for DRIP_TEMPLATE_ENGINE
+    template_engine = None
+    #: render and deliver this many messages at a time, None for DRIP_SEND_BATCH_SIZE
+    send_batch_size = None
+    #: page through the queryset by primary key instead of loading it all at once,
+    #: None for DRIP_STREAM_USERS
+    stream_users = None
+    #: render into the DripOutbox on run, leaving delivery to drain_drip_outbox,
+    #: None for DRIP_USE_OUTBOX
+    use_outbox = None
+    #: buffer this many SentDrips and bulk insert them, None for DRIP_SENT_BATCH_SIZE
+    #: (saving one at a time if that is unset too)
+    sent_batch_size = None
+    #: keep SentDrip subjects and bodies in SentDripContent, once per distinct text,
+    #: None for DRIP_COMPRESS_SENT_DRIPS
+    compress_sent_drips = None
 
     def __init__(self, drip_model, *args, **kwargs):
         self.drip_model = drip_model
@@ -118,6 +179,25 @@ class DripBase(object):
         self.from_email_name = kwargs.pop('from_email_name', self.from_email_name)
         self.subject_template = kwargs.pop('subject_template', self.subject_template)
         self.body_template = kwargs.pop('body_template', self.body_template)
+        self.template_engine = kwargs.pop('template_engine', self.template_engine)
+        self.send_batch_size = kwargs.pop('send_batch_size', self.send_batch_size)
+        if self.send_batch_size is None:
+            self.send_batch_size = getattr(settings, 'DRIP_SEND_BATCH_SIZE', 100)
+        self.stream_users = kwargs.pop('stream_users', self.stream_users)
+        if self.stream_users is None:
+            self.stream_users = getattr(settings, 'DRIP_STREAM_USERS', False)
+        self.use_outbox = kwargs.pop('use_outbox', self.use_outbox)
+        if self.use_outbox is None:
+            self.use_outbox = getattr(settings, 'DRIP_USE_OUTBOX', False)
+        self.sent_batch_size = kwargs.pop('sent_batch_size', self.sent_batch_size)
+        if self.sent_batch_size is None:
+            self.sent_batch_size = getattr(settings, 'DRIP_SENT_BATCH_SIZE', None)
+        self.compress_sent_drips = kwargs.pop('compress_sent_drips', self.compress_sent_drips)
+        if self.compress_sent_drips is None:
+            self.compress_sent_drips = getattr(settings, 'DRIP_COMPRESS_SENT_DRIPS', False)
+        self.instrumentation = kwargs.pop('instrumentation', None) or get_instrumentation()
+        if 'queryset_rules' in kwargs:
+            self._queryset_rules = kwargs.pop('queryset_rules')
 
         if not self.name:
             raise AttributeError('You must define a name.')
@@ -125,6 +205,25 @@ class DripBase(object):
         self.now_shift_kwargs = kwargs.get('now_shift_kwargs', {})
 
 
+    #######################
+    ### INSTRUMENTATION ###
+    #######################
+
+    @contextmanager
+    def measure(self, event):
+        """
+        Report the time spent in the block to the instrumentation.
+        """
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.instrumentation.timing(event, time.time() - started,
+                                        drip_id=self.drip_model.id, drip_name=self.name)
+
+    def report(self, event, value):
+        self.instrumentation.count(event, value, drip_id=self.drip_model.id, drip_name=self.name)
+
     #########################
     ### DATE MANIPULATION ###
     #########################
@@ -146,15 +245,118 @@ class DripBase(object):
     def walk(self, into_past=0, into_future=0):
         """
         Walk over a date range and create new instances of self with new ranges.
+
+        The instances share this drip's QuerySetRules, which are fetched once.
         """
         walked_range = []
+        queryset_rules = self.get_queryset_rules()
         for shift in range(-into_past, into_future):
             kwargs = dict(drip_model=self.drip_model,
                           name=self.name,
+                          template_engine=self.template_engine,
+                          queryset_rules=queryset_rules,
                           now_shift_kwargs={'days': shift})
             walked_range.append(self.__class__(**kwargs))
         return walked_range
 
+    def timeline(self, into_past=0, into_future=0):
+        """
+        Walk over a date range like walk(), returning (shifted drip, users)
+        for each day, with every user listed only on the first day they
+        would get the drip.
+        """
+        shifted_drips = self.walk(into_past=into_past, into_future=into_future)
+        first_days = self.first_days(shifted_drips)
+        users_by_day = [[] for shifted_drip in shifted_drips]
+        for user in self.first_day_users(first_days):
+            users_by_day[user.drip_day].append(user)
+        return list(zip(shifted_drips, users_by_day))
+
+    def first_days(self, shifted_drips):
+        """
+        Prune the `shifted_drips` and return (sql, params) for a query of
+        every user any of them selects, as `user_id`, with the index of the
+        first one selecting them as `day`.
+
+        Every day's queryset becomes a derived table of user ids tagged
+        with its day, and the days are combined with UNION ALL and grouped
+        by user to find their first day.
+        """
+        qn = connections[self.queryset().db].ops.quote_name
+        pk = qn(self.queryset().model._meta.pk.column)
+
+        days, params = [], []
+        for day, shifted_drip in enumerate(shifted_drips):
+            shifted_drip.prune()
+            sql, day_params = shifted_drip.get_queryset().values_list('pk').query.sql_with_params()
+            days.append('SELECT day_users.%s AS user_id, %d AS day FROM (%s) day_users' % (pk, day, sql))
+            params.extend(day_params)
+        if not days:
+            # nothing to walk, select no users
+            days.append('SELECT NULL AS user_id, 0 AS day')
+
+        sql = ('SELECT days.user_id, MIN(days.day) AS day FROM (%s) days '
+               'GROUP BY days.user_id' % ' UNION ALL '.join(days))
+        return sql, params
+
+    def first_day_counts(self, first_days, days):
+        """
+        Returns the number of users in `first_days` for each of `days`
+        days, in one query.
+        """
+        sql, params = first_days
+        cursor = connections[self.queryset().db].cursor()
+        cursor.execute('SELECT first_days.day, COUNT(*) FROM (%s) first_days '
+                       'WHERE first_days.user_id IS NOT NULL GROUP BY first_days.day' % sql, params)
+        counts = dict(cursor.fetchall())
+        return [counts.get(day, 0) for day in range(days)]
+
+    def first_day_users(self, first_days, day=None, after=None, limit=None):
+        """
+        Returns the users in `first_days`, each with their first day as
+        `drip_day`, ordered by day and primary key, in one query.
+
+        Pass `day` for a single day's users, and `after` (a primary key)
+        and `limit` to page through them.
+        """
+        model = self.queryset().model
+        using = self.queryset().db
+        qn = connections[using].ops.quote_name
+        pk = qn(model._meta.pk.column)
+        users = qn(model._meta.db_table)
+
+        sql, params = first_days
+        params = list(params)
+        where = []
+        if day is not None:
+            where.append('first_days.day = %s')
+            params.append(day)
+        if after is not None:
+            where.append('%s.%s > %%s' % (users, pk))
+            params.append(after)
+
+        sql = ('SELECT {users}.*, first_days.day AS drip_day FROM {users} '
+               'INNER JOIN ({first_days}) first_days ON first_days.user_id = {users}.{pk}').format(
+            users=users, pk=pk, first_days=sql)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY first_days.day, {users}.{pk}'.format(users=users, pk=pk)
+        if limit is not None:
+            sql += ' LIMIT %d' % limit
+
+        return list(model._default_manager.db_manager(using).raw(sql, params))
+
+    def get_queryset_rules(self):
+        """
+        The drip's QuerySetRules, fetched once per instance. Drips loaded
+        with prefetch_related('queryset_rules') don't query at all.
+        """
+        try:
+            return self._queryset_rules
+        except AttributeError:
+            self._queryset_rules = list(self.drip_model.queryset_rules.all())
+            return self._queryset_rules
+
     def apply_queryset_rules(self, qs):
         """
         First collect all filter/exclude kwargs and apply any annotations.
@@ -164,19 +366,22 @@ class DripBase(object):
             'filter': [],
             'exclude': []}
 
-        for rule in self.drip_model.queryset_rules.all():
+        with self.measure('rules'):
+            rules = self.get_queryset_rules()
+            for rule in rules:
 
-            clause = clauses.get(rule.method_type, clauses['filter'])
+                clause = clauses.get(rule.method_type, clauses['filter'])
 
-            kwargs = rule.filter_kwargs(qs, now=self.now)
-            clause.append(Q(**kwargs))
+                kwargs = rule.filter_kwargs(qs, now=self.now)
+                clause.append(Q(**kwargs))
 
-            qs = rule.apply_any_annotation(qs)
+                qs = rule.apply_any_annotation(qs)
 
-        if clauses['exclude']:
-            qs = qs.exclude(functools.reduce(operator.or_, clauses['exclude']))
-        qs = qs.filter(*clauses['filter'])
+            if clauses['exclude']:
+                qs = qs.exclude(functools.reduce(operator.or_, clauses['exclude']))
+            qs = qs.filter(*clauses['filter'])
 
+        self.report('rules', len(rules))
         return qs
 
     ##################
@@ -191,7 +396,21 @@ class DripBase(object):
                                  .distinct()
             return self._queryset
 
-    def run(self):
+    def get_subject_template(self):
+        try:
+            return self._subject_template
+        except AttributeError:
+            self._subject_template = compile_template(self.subject_template, self.template_engine)
+            return self._subject_template
+
+    def get_body_template(self):
+        try:
+            return self._body_template
+        except AttributeError:
+            self._body_template = compile_template(self.body_template, self.template_engine)
+            return self._body_template
+
+    def run(self, delivery=None):
         """
         Get the queryset, prune sent people, and send it.
         """
@@ -199,51 +418,306 @@ class DripBase(object):
             return None
 
         self.prune()
-        count = self.send()
+        if self.use_outbox:
+            return self.enqueue()
+        count = self.send(delivery=delivery)
 
         return count
 
     def prune(self):
         """
-        Do an exclude for all Users who have a SentDrip already.
+        Do an exclude for all Users who have a SentDrip already, or who
+        are waiting in the outbox when it is used.
+
+        Each is a correlated NOT EXISTS folded into the queryset's own
+        WHERE, so the database can plan it as one anti-join on the
+        (drip, user) index instead of scanning the candidates twice.
+        The subquery refers to the user table by name, so the pruned
+        queryset shouldn't be nested inside another query.
         """
-        target_user_ids = self.get_queryset().values_list('id', flat=True)
-        exclude_user_ids = SentDrip.objects.filter(date__lt=conditional_now(),
-                                                   drip=self.drip_model,
-                                                   user__id__in=target_user_ids)\
-                                           .values_list('user_id', flat=True)
-        self._queryset = self.get_queryset().exclude(id__in=exclude_user_ids)
+        qs = self.get_queryset()
+        with self.measure('prune'):
+            connection = connections[qs.db]
+            now = connection.ops.value_to_db_datetime(conditional_now())
+
+            qs = self.exclude_recorded(qs, SentDrip, params=[now])
+            if self.use_outbox:
+                qs = self.exclude_recorded(qs, DripOutbox)
+            self._queryset = qs
 
-    def send(self):
+    def exclude_recorded(self, qs, Model, params=None):
+        """
+        Exclude users with a row in Model (SentDrip or DripOutbox) for
+        this drip, dated before the extra date param if one is given.
+        """
+        qn = connections[qs.db].ops.quote_name
+        table = qn(Model._meta.db_table)
+        where = (
+            'NOT EXISTS (SELECT 1 FROM {table} WHERE {table}.{drip} = %s '
+            'AND {table}.{user} = {users}.{pk}'
+        ).format(
+            table=table,
+            drip=qn(Model._meta.get_field('drip').column),
+            user=qn(Model._meta.get_field('user').column),
+            users=qn(qs.model._meta.db_table),
+            pk=qn(qs.model._meta.pk.column))
+        if params:
+            where += ' AND {table}.{date} < %s'.format(
+                table=table, date=qn(Model._meta.get_field('date').column))
+        where += ')'
+
+        return qs.extra(where=[where], params=[self.drip_model.pk] + list(params or []))
+
+    def build_sent_drip(self, user, message_instance):
         """
-        Send the message to each user on the queryset.
+        Returns an unsaved SentDrip recording the message sent to the user.
+        """
+        return SentDrip(
+            drip=self.drip_model,
+            user=user,
+            from_email=self.from_email,
+            from_email_name=self.from_email_name,
+            subject=message_instance.subject,
+            body=message_instance.body
+        )
+
+    def save_sent_drip(self, sent_drip):
+        """
+        Save a single SentDrip, ignoring it if the user already has one
+        for this drip. Returns the number of rows written.
+        """
+        if self.compress_sent_drips:
+            self.store_sent_content([sent_drip])
+        try:
+            with self.measure('record'), atomic():
+                sent_drip.save()
+        except IntegrityError:
+            return 0
+        self.report('recorded', 1)
+        return 1
+
+    def record_sent_drips(self, sent_drips, fail_silently=True):
+        """
+        Bulk insert SentDrips in chunks of `sent_batch_size`, one
+        transaction per chunk, skipping users already recorded for this
+        drip (say by a run that crashed part way through).
 
-        Create SentDrip for each user that gets a message.
+        A chunk that fails to insert is logged and skipped, unless
+        `fail_silently` is False.
 
-        Returns count of created SentDrips.
+        Returns the number of rows written.
+        """
+        batch_size = self.sent_batch_size or len(sent_drips)
+        count = 0
+        for start in range(0, len(sent_drips), batch_size):
+            chunk = sent_drips[start:start + batch_size]
+            try:
+                count += self.insert_sent_drips(chunk)
+            except Exception as e:
+                if not fail_silently:
+                    raise
+                logging.error("Failed to record %d sent drips for drip %s: %s" % (len(chunk), self.drip_model.id, e))
+        return count
+
+    def insert_sent_drips(self, chunk):
+        seen_user_ids = set(SentDrip.objects.filter(drip=self.drip_model,
+                                                    user__id__in=[sent.user_id for sent in chunk])
+                                            .values_list('user_id', flat=True))
+        new_sent_drips = []
+        for sent_drip in chunk:
+            if sent_drip.user_id not in seen_user_ids:
+                seen_user_ids.add(sent_drip.user_id)
+                new_sent_drips.append(sent_drip)
+
+        if self.compress_sent_drips:
+            self.store_sent_content(new_sent_drips)
+        try:
+            with self.measure('record'), atomic():
+                SentDrip.objects.bulk_create(new_sent_drips)
+        except IntegrityError:
+            # another run recorded some of these in the meantime
+            return sum(self.save_sent_drip(sent_drip) for sent_drip in new_sent_drips)
+        self.report('recorded', len(new_sent_drips))
+        return len(new_sent_drips)
+
+    def store_sent_content(self, sent_drips):
+        """
+        Move the subject and body of each SentDrip into SentDripContent,
+        leaving only a reference by hash behind. Texts are compressed and
+        stored once, however many SentDrips share them.
+        """
+        pending = []
+        for sent_drip in sent_drips:
+            for field in ('subject', 'body'):
+                text = sent_drip.__dict__.get(field)
+                if text:
+                    pending.append((sent_drip, field, SentDripContent.hash_text(text), text))
+        if not pending:
+            return
+
+        texts = dict((key, text) for sent_drip, field, key, text in pending)
+        stored = set(SentDripContent.objects.filter(hash__in=list(texts)).values_list('hash', flat=True))
+        contents = [SentDripContent(hash=key, data=SentDripContent.compress(text))
+                    for key, text in texts.items() if key not in stored]
+        try:
+            with atomic():
+                SentDripContent.objects.bulk_create(contents)
+        except IntegrityError:
+            # another run stored some of these in the meantime
+            for content in contents:
+                with atomic():
+                    SentDripContent.objects.get_or_create(hash=content.hash, defaults={'data': content.data})
+
+        for sent_drip, field, key, text in pending:
+            setattr(sent_drip, '%s_content_id' % field, key)
+            setattr(sent_drip, field, '')
+
+    def enqueue(self):
         """
+        Render the message for each user on the queryset into the
+        DripOutbox, for `drain_drip_outbox` to deliver.
 
+        Returns count of queued messages.
+        """
         if not self.from_email:
             self.from_email = getattr(settings, 'DRIP_FROM_EMAIL', settings.DEFAULT_FROM_EMAIL)
         MessageClass = message_class_for(self.drip_model.message_class)
 
         count = 0
-        for user in self.get_queryset():
-            message_instance = MessageClass(self, user)
+        for users in self.iter_user_batches():
+            rows = [
+                DripOutbox(
+                    drip=self.drip_model,
+                    user=message_instance.user,
+                    from_email=self.from_email,
+                    from_email_name=self.from_email_name,
+                    subject=message_instance.subject,
+                    body=message_instance.body)
+                for message_instance in self.render_messages(MessageClass, users)]
             try:
-                result = message_instance.message.send()
-                if result:
-                    SentDrip.objects.create(
-                        drip=self.drip_model,
-                        user=user,
-                        from_email=self.from_email,
-                        from_email_name=self.from_email_name,
-                        subject=message_instance.subject,
-                        body=message_instance.body
-                    )
-                    count += 1
+                with atomic():
+                    DripOutbox.objects.bulk_create(rows)
             except Exception as e:
-                logging.error("Failed to send drip %s to user %s: %s" % (self.drip_model.id, user, e))
+                logging.error("Failed to queue %d messages for drip %s: %s" % (len(rows), self.drip_model.id, e))
+                continue
+            count += len(rows)
+        return count
+
+    def iter_user_batches(self):
+        """
+        Yield lists of at most `send_batch_size` users from the queryset,
+        without keeping the whole queryset in memory.
+        """
+        qs = self.get_queryset()
+
+        # sliced querysets can't be filtered any further
+        if self.stream_users and not (qs.query.low_mark or qs.query.high_mark):
+            for batch in self.iter_user_pages(qs):
+                yield batch
+            return
+
+        batch = []
+        for user in qs.iterator():
+            batch.append(user)
+            if len(batch) >= self.send_batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def iter_user_pages(self, qs):
+        """
+        Walk the queryset in primary key order, one `send_batch_size`
+        page per query, so memory use doesn't grow with the audience.
+        """
+        qs = qs.order_by('pk')
+        last_pk = None
+        while True:
+            page_qs = qs if last_pk is None else qs.filter(pk__gt=last_pk)
+            page = list(page_qs[:self.send_batch_size])
+            if page:
+                yield page
+            if len(page) < self.send_batch_size:
+                return
+            last_pk = page[-1].pk
+
+    def render_messages(self, MessageClass, users):
+        """
+        Build and render a message for each user, skipping (and logging)
+        any that fail to render.
+        """
+        message_instances = []
+        with self.measure('render'):
+            for message_instance in MessageClass.render_many(self, users):
+                try:
+                    message_instance.message
+                except Exception as e:
+                    logging.error("Failed to send drip %s to user %s: %s" % (self.drip_model.id, message_instance.user, e))
+                    continue
+                message_instances.append(message_instance)
+        return message_instances
+
+    def send(self, delivery=None):
+        """
+        Send the message to each user on the queryset, in batches over
+        a single backend connection. Pass a `delivery` to share one
+        across several drips.
+
+        Create SentDrip for each user that gets a message, buffering
+        them for bulk inserts if `sent_batch_size` is set.
+
+        Returns count of created SentDrips.
+        """
+
+        if not self.from_email:
+            self.from_email = getattr(settings, 'DRIP_FROM_EMAIL', settings.DEFAULT_FROM_EMAIL)
+        MessageClass = message_class_for(self.drip_model.message_class)
+
+        own_delivery = delivery is None
+        if own_delivery:
+            delivery = get_delivery()
+            delivery.open()
+
+        count = 0
+        pending = []
+        try:
+            batches = self.iter_user_batches()
+            while True:
+                with self.measure('query'):
+                    users = next(batches, None)
+                if users is None:
+                    break
+
+                message_instances = self.render_messages(MessageClass, users)
+                with self.measure('send'):
+                    results = delivery.deliver(message_instances)
+                sent = sum(1 for result in results if result)
+                self.report('sent', sent)
+                self.report('failed', len(results) - sent)
+
+                for message_instance, result in zip(message_instances, results):
+                    if not result:
+                        continue
+                    sent_drip = self.build_sent_drip(message_instance.user, message_instance)
+                    if self.sent_batch_size:
+                        pending.append(sent_drip)
+                        if len(pending) >= self.sent_batch_size:
+                            count += self.record_sent_drips(pending)
+                            pending = []
+                    else:
+                        try:
+                            count += self.save_sent_drip(sent_drip)
+                        except Exception as e:
+                            logging.error("Failed to record drip %s for user %s: %s" % (
+                                self.drip_model.id, message_instance.user, e))
+        finally:
+            # record what was already sent even if a later batch failed
+            try:
+                if pending:
+                    count += self.record_sent_drips(pending)
+            finally:
+                if own_delivery:
+                    delivery.close()
 
         return count
 
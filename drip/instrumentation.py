@@ -0,0 +1,97 @@
+"""
+Hooks for timing and counting what drips do.
+
+Point `DRIP_INSTRUMENTATION` at a subclass of `Instrumentation` to
+receive events. Each one carries the drip's id and name:
+
+    rules       timing of applying the QuerySetRules, count of rules
+    prune       timing of pruning already sent users
+    query       timing of fetching each batch of users
+    render      timing of rendering each batch of messages
+    send        timing of delivering each batch, counts of sent and failed
+    record      timing of writing SentDrips, count of recorded
+"""
+import logging
+import socket
+from importlib import import_module
+
+from django.conf import settings
+
+
+class Instrumentation(object):
+    """
+    Receives timing (in seconds) and count events. The default ignores
+    them all.
+    """
+
+    def timing(self, event, seconds, drip_id=None, drip_name=None):
+        pass
+
+    def count(self, event, value, drip_id=None, drip_name=None):
+        pass
+
+
+class LoggingInstrumentation(Instrumentation):
+    """
+    Logs every event to the `drip.instrumentation` logger at INFO.
+    """
+    logger = logging.getLogger('drip.instrumentation')
+
+    def timing(self, event, seconds, drip_id=None, drip_name=None):
+        self.logger.info('drip=%s name=%r %s=%.6fs', drip_id, drip_name, event, seconds)
+
+    def count(self, event, value, drip_id=None, drip_name=None):
+        self.logger.info('drip=%s name=%r %s=%d', drip_id, drip_name, event, value)
+
+
+class StatsdInstrumentation(Instrumentation):
+    """
+    Sends every event as a statsd UDP packet to `DRIP_STATSD_HOST` and
+    `DRIP_STATSD_PORT` (localhost:8125), named
+    `<DRIP_STATSD_PREFIX>.<event>` (prefix "drip").
+
+    The drip is added as DogStatsD style tags when `DRIP_STATSD_TAGS`
+    is set, otherwise it goes into the name: `drip.<drip id>.<event>`.
+    """
+
+    def __init__(self, host=None, port=None, prefix=None, tags=None):
+        self.address = (host or getattr(settings, 'DRIP_STATSD_HOST', 'localhost'),
+                        port or getattr(settings, 'DRIP_STATSD_PORT', 8125))
+        self.prefix = prefix or getattr(settings, 'DRIP_STATSD_PREFIX', 'drip')
+        self.tags = getattr(settings, 'DRIP_STATSD_TAGS', False) if tags is None else tags
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def packet(self, event, value, kind, drip_id, drip_name):
+        if self.tags:
+            return '%s.%s:%s|%s|#drip_id:%s,drip_name:%s' % (self.prefix, event, value, kind, drip_id, drip_name)
+        return '%s.%s.%s:%s|%s' % (self.prefix, drip_id, event, value, kind)
+
+    def send(self, packet):
+        try:
+            self.socket.sendto(packet.encode('utf-8'), self.address)
+        except (socket.error, UnicodeError):
+            # metrics are fire and forget
+            pass
+
+    def timing(self, event, seconds, drip_id=None, drip_name=None):
+        self.send(self.packet(event, int(seconds * 1000), 'ms', drip_id, drip_name))
+
+    def count(self, event, value, drip_id=None, drip_name=None):
+        self.send(self.packet(event, value, 'c', drip_id, drip_name))
+
+
+_instrumentation = {}
+
+
+def get_instrumentation():
+    """
+    Returns the (shared) instance of the `DRIP_INSTRUMENTATION` class.
+    """
+    path = getattr(settings, 'DRIP_INSTRUMENTATION', 'drip.instrumentation.Instrumentation')
+    try:
+        return _instrumentation[path]
+    except KeyError:
+        mod_name, klass_name = path.rsplit('.', 1)
+        klass = getattr(import_module(mod_name), klass_name)
+        instrumentation = _instrumentation[path] = klass()
+        return instrumentation
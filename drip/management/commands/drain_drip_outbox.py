@@ -0,0 +1,30 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Deliver the rendered messages waiting in the drip outbox.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=None,
+            help='Number of threads delivering messages concurrently, overrides DRIP_SEND_WORKERS.'),
+        make_option('--batch-size', type='int', dest='batch_size', default=100,
+            help='Number of outbox rows claimed at a time.'),
+        make_option('--max-attempts', type='int', dest='max_attempts', default=3,
+            help='Stop retrying a message after this many failed sends, leaving it in the outbox.'),
+        make_option('--claim-timeout', type='int', dest='claim_timeout', default=600,
+            help='Seconds before rows claimed by another (presumably dead) drainer can be claimed again.'),
+    )
+
+    def handle(self, *args, **options):
+        from drip.delivery import get_delivery
+        from drip.outbox import drain
+
+        with get_delivery(workers=options.get('workers')) as delivery:
+            sent, failed = drain(delivery,
+                                 batch_size=options['batch_size'],
+                                 max_attempts=options['max_attempts'],
+                                 claim_timeout=options['claim_timeout'])
+
+        self.stdout.write('Sent %d, failed %d\n' % (sent, failed))
@@ -0,0 +1,43 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = ('Time prune, walk, the admin timeline and a full run of a drip against a synthetic '
+            'population, in a throwaway test database.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--users', type='int', dest='users', default=100000,
+            help='Number of synthetic users to create.'),
+        make_option('--history', type='float', dest='history', default=0.5,
+            help='Fraction of users with SentDrip history on each drip.'),
+        make_option('--history-drips', type='int', dest='history_drips', default=3,
+            help='Number of extra drips to create SentDrip history for.'),
+        make_option('--past', type='int', dest='into_past', default=3,
+            help='Days into the past to walk and show on the timeline.'),
+        make_option('--future', type='int', dest='into_future', default=7,
+            help='Days into the future to walk and show on the timeline.'),
+    )
+
+    def handle(self, *args, **options):
+        import time
+        from django.db import connection
+        from drip.benchmark import generate_fixture, run_scale_benchmark, format_scale_benchmark
+
+        # never fill (or time) the real database
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            started = time.time()
+            drip = generate_fixture(users=options['users'],
+                                    history=options['history'],
+                                    history_drips=options['history_drips'])
+            self.stdout.write('Created %d users in %.1fs\n' % (options['users'], time.time() - started))
+
+            results = run_scale_benchmark(drip,
+                                          into_past=options['into_past'],
+                                          into_future=options['into_future'])
+            self.stdout.write(format_scale_benchmark(results) + '\n')
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
@@ -1,9 +1,120 @@
+from optparse import make_option
+
 from django.core.management.base import BaseCommand, CommandError
 
 
+def setup_worker():
+    # spawned (rather than forked) workers need the app registry loaded
+    import django
+    if hasattr(django, 'setup'):
+        django.setup()
+
+
+def enabled_drips():
+    """
+    The enabled drips, with all their QuerySetRules fetched in one query.
+    """
+    from drip.models import Drip
+
+    return Drip.objects.filter(enabled=True).prefetch_related('queryset_rules')
+
+
+def run_drip(task):
+    """
+    Run one drip inside a worker process.
+
+    Returns (drip_id, count, error) so the parent can report on it.
+    """
+    from drip.models import Drip
+    from drip.delivery import get_delivery
+
+    drip_id, workers, engine = task
+    try:
+        drip = Drip.objects.prefetch_related('queryset_rules').get(id=drip_id)
+        with get_delivery(workers=workers, engine=engine) as delivery:
+            count = drip.drip.run(delivery=delivery)
+    except Exception as e:
+        return drip_id, None, '%s: %s' % (type(e).__name__, e)
+    return drip_id, count, None
+
+
 class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=None,
+            help='Number of threads delivering messages concurrently, overrides DRIP_SEND_WORKERS.'),
+        make_option('--engine', dest='engine', default=None, choices=['threads', 'asyncio'],
+            help='Deliver from worker threads (default) or an asyncio event loop, overrides DRIP_SEND_ENGINE.'),
+        make_option('--processes', type='int', dest='processes', default=None,
+            help='Spread enabled drips across this many processes, largest drips first.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Render every message but send nothing and record no SentDrips.'),
+        make_option('--benchmark', action='store_true', dest='benchmark', default=False,
+            help='With --dry-run, report the time spent in each stage of every drip.'),
+    )
+
     def handle(self, *args, **options):
-        from drip.models import Drip
+        from drip.delivery import get_delivery
+
+        if options.get('dry_run'):
+            return self.handle_dry_run(options.get('benchmark'))
+        if options.get('benchmark'):
+            raise CommandError('--benchmark only works with --dry-run.')
+
+        processes = options.get('processes')
+        if processes and processes > 1:
+            return self.handle_processes(processes, options.get('workers'), options.get('engine'))
+
+        # one set of backend connections shared by every drip
+        with get_delivery(workers=options.get('workers'), engine=options.get('engine')) as delivery:
+            for drip in enabled_drips():
+                drip.drip.run(delivery=delivery)
+
+    def handle_dry_run(self, benchmark):
+        from drip.benchmark import benchmark_drip, format_benchmark
+
+        for drip in enabled_drips():
+            result = benchmark_drip(drip.drip)
+            if benchmark:
+                self.stdout.write(format_benchmark(result) + '\n')
+            else:
+                self.stdout.write('Drip %s (%s) would send %d\n' % (drip.id, drip.name, result['audience']))
+
+    def audience_sizes(self):
+        """
+        Returns (drip_id, audience size) for every enabled drip,
+        largest audience first.
+        """
+        sizes = []
+        for drip in enabled_drips():
+            drip_base = drip.drip
+            drip_base.prune()
+            sizes.append((drip.id, drip_base.get_queryset().count()))
+        return sorted(sizes, key=lambda size: size[1], reverse=True)
+
+    def handle_processes(self, processes, workers, engine):
+        import multiprocessing
+        from django.db import connections
+
+        tasks = [(drip_id, workers, engine) for drip_id, size in self.audience_sizes()]
+
+        # never hand an open database connection to forked workers
+        for connection in connections.all():
+            connection.close()
+
+        pool = multiprocessing.Pool(processes, initializer=setup_worker)
+        try:
+            results = list(pool.imap_unordered(run_drip, tasks))
+        finally:
+            pool.close()
+            pool.join()
+
+        failed = 0
+        for drip_id, count, error in results:
+            if error:
+                failed += 1
+                self.stderr.write('Drip %s failed: %s\n' % (drip_id, error))
+            else:
+                self.stdout.write('Drip %s sent %s\n' % (drip_id, count))
 
-        for drip in Drip.objects.filter(enabled=True):
-            drip.drip.run()
+        if failed:
+            raise CommandError('%d of %d drips failed.' % (failed, len(results)))
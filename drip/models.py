@@ -1,3 +1,6 @@
+import base64
+import hashlib
+import zlib
 from datetime import datetime, timedelta
 
 from django.db import models
@@ -48,17 +51,100 @@ class Drip(models.Model):
         return self.name
 
 
+class SentDripContent(models.Model):
+    """
+    A subject or body shared by every SentDrip sent with the same text,
+    stored once under the SHA-1 of the text and zlib compressed (base64
+    encoded to fit a TextField on every database).
+    """
+    hash = models.CharField(max_length=40, primary_key=True)
+    data = models.TextField()
+
+    @staticmethod
+    def hash_text(text):
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def compress(text):
+        return base64.b64encode(zlib.compress(text.encode('utf-8'))).decode('ascii')
+
+    @property
+    def text(self):
+        return zlib.decompress(base64.b64decode(self.data)).decode('utf-8')
+
+
+class ContentDescriptor(object):
+    """
+    Reads a ContentTextField, falling back to its SentDripContent when
+    the column itself is empty.
+    """
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = instance.__dict__.get(self.field.attname, '')
+        if value or getattr(instance, '%s_id' % self.field.content_field) is None:
+            return value
+        return getattr(instance, self.field.content_field).text
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+
+class ContentTextField(models.TextField):
+    """
+    A TextField whose text may live in SentDripContent instead, behind
+    the `content_field` foreign key. Reading it always gives the text,
+    saving it only writes what is in the column.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.content_field = kwargs.pop('content_field')
+        super(ContentTextField, self).__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(ContentTextField, self).deconstruct()
+        kwargs['content_field'] = self.content_field
+        return name, path, args, kwargs
+
+    def contribute_to_class(self, cls, name):
+        super(ContentTextField, self).contribute_to_class(cls, name)
+        setattr(cls, self.name, ContentDescriptor(self))
+
+    def pre_save(self, model_instance, add):
+        return model_instance.__dict__.get(self.attname, '')
+
+try:
+    from south.modelsinspector import add_introspection_rules
+    add_introspection_rules([
+        ([ContentTextField], [], {'content_field': ['content_field', {}]}),
+    ], [r'^drip\.models\.ContentTextField'])
+except ImportError:
+    pass
+
+
 class SentDrip(models.Model):
     """
     Keeps a record of all sent drips.
+
+    With DRIP_COMPRESS_SENT_DRIPS the subject and body columns are left
+    empty and the text is kept in SentDripContent, which `subject` and
+    `body` read through to.
     """
     date = models.DateTimeField(auto_now_add=True)
 
     drip = models.ForeignKey('drip.Drip', related_name='sent_drips')
     user = models.ForeignKey(getattr(settings, 'AUTH_USER_MODEL', 'auth.User'), related_name='sent_drips')
 
-    subject = models.TextField()
-    body = models.TextField()
+    subject = ContentTextField(content_field='subject_content')
+    body = ContentTextField(content_field='body_content')
+    subject_content = models.ForeignKey(SentDripContent, null=True, blank=True, related_name='+',
+                                        on_delete=models.PROTECT)
+    body_content = models.ForeignKey(SentDripContent, null=True, blank=True, related_name='+',
+                                     on_delete=models.PROTECT)
     from_email = models.EmailField(
         null=True, default=None # For south so that it can migrate existing rows.
     )
@@ -66,6 +152,38 @@ class SentDrip(models.Model):
         null=True, default=None # For south so that it can migrate existing rows.
     )
 
+    class Meta:
+        # a user only ever gets a drip once, also indexes prune lookups
+        unique_together = (('drip', 'user'),)
+
+
+class DripOutbox(models.Model):
+    """
+    A rendered drip message waiting to be sent by `drain_drip_outbox`.
+
+    Rows are claimed by a drainer before sending and deleted once their
+    SentDrip is written, so a crashed run leaves its unsent work here.
+    `sent_at` is set as soon as a message is delivered, so a row whose
+    SentDrip failed to be written is only recorded again, never resent.
+    """
+    date = models.DateTimeField(auto_now_add=True)
+
+    drip = models.ForeignKey('drip.Drip', related_name='outbox')
+    user = models.ForeignKey(getattr(settings, 'AUTH_USER_MODEL', 'auth.User'), related_name='drip_outbox')
+
+    subject = models.TextField()
+    body = models.TextField()
+    from_email = models.EmailField(null=True, default=None)
+    from_email_name = models.CharField(max_length=150, null=True, default=None)
+
+    claimed_by = models.CharField(max_length=32, null=True, blank=True, db_index=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = (('drip', 'user'),)
+
 
 
 METHOD_TYPES = (
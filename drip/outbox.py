@@ -0,0 +1,105 @@
+"""
+Claiming and delivering rendered messages from the DripOutbox.
+"""
+import uuid
+from datetime import timedelta
+
+from django.db.models import F, Q
+
+from drip.drips import conditional_now, message_class_for, atomic
+from drip.models import DripOutbox
+
+
+def claim(batch_size=100, max_attempts=3, claim_timeout=600):
+    """
+    Claim up to `batch_size` unsent rows for this drainer and return them.
+
+    Rows claimed more than `claim_timeout` seconds ago are assumed to
+    belong to a crashed drainer and may be claimed again. The claiming
+    UPDATE re-checks the claim, so concurrent drainers never share a row.
+    """
+    token = uuid.uuid4().hex
+    now = conditional_now()
+    claimable = Q(claimed_by__isnull=True) | Q(claimed_at__lt=now - timedelta(seconds=claim_timeout))
+
+    ids = list(DripOutbox.objects.filter(claimable, attempts__lt=max_attempts)
+                                 .order_by('id')
+                                 .values_list('id', flat=True)[:batch_size])
+    if not ids:
+        return []
+
+    DripOutbox.objects.filter(claimable, id__in=ids).update(claimed_by=token, claimed_at=now)
+    return list(DripOutbox.objects.filter(claimed_by=token).select_related('drip', 'user'))
+
+
+def message_instances_for(rows):
+    """
+    Rebuild each row's message with its drip's message class, reusing
+    the stored subject and body instead of rendering them again.
+    """
+    drip_bases, message_classes = {}, {}
+    message_instances = []
+    for row in rows:
+        if row.drip_id not in drip_bases:
+            drip_base = drip_bases[row.drip_id] = row.drip.drip
+            drip_base.from_email = row.from_email
+            drip_base.from_email_name = row.from_email_name
+            message_classes[row.drip_id] = message_class_for(row.drip.message_class)
+
+        message_instance = message_classes[row.drip_id](drip_bases[row.drip_id], row.user)
+        message_instance._subject = row.subject
+        message_instance._body = row.body
+        message_instances.append(message_instance)
+    return message_instances
+
+
+def drain(delivery, batch_size=100, max_attempts=3, claim_timeout=600):
+    """
+    Deliver claimed outbox rows until none are left, writing a SentDrip
+    and deleting the row for each message sent.
+
+    Failed rows stay claimed, so they are retried by a later drain once
+    their claim times out, until they reach `max_attempts`. Rows that
+    reach it are left in the outbox for good, and keep their users
+    pruned from the drip until they are deleted by hand.
+
+    Each delivered row is marked `sent_at` before its SentDrip is
+    written. If that fails the error is raised and none of the batch's
+    rows are deleted: a later drain records them without sending them
+    again.
+
+    Returns (sent, failed) counts.
+    """
+    sent = failed = 0
+    while True:
+        rows = claim(batch_size, max_attempts, claim_timeout)
+        if not rows:
+            return sent, failed
+
+        message_instances = message_instances_for(rows)
+        # rows an earlier drain sent but failed to record are only recorded this time
+        unsent = [i for i, row in enumerate(rows) if row.sent_at is None]
+        results = [True] * len(rows)
+        for i, result in zip(unsent, delivery.deliver([message_instances[i] for i in unsent])):
+            results[i] = result
+        DripOutbox.objects.filter(id__in=[rows[i].id for i in unsent if results[i]]) \
+                          .update(sent_at=conditional_now())
+
+        sent_drips = {}
+        sent_ids, failed_ids = [], []
+        for row, message_instance, result in zip(rows, message_instances, results):
+            if result:
+                drip_base = message_instance.drip_base
+                sent_drips.setdefault(drip_base, []).append(drip_base.build_sent_drip(row.user, message_instance))
+                sent_ids.append(row.id)
+            else:
+                failed_ids.append(row.id)
+
+        with atomic():
+            for drip_base, drip_sent_drips in sent_drips.items():
+                drip_base.record_sent_drips(drip_sent_drips, fail_silently=False)
+            DripOutbox.objects.filter(id__in=sent_ids).delete()
+            DripOutbox.objects.filter(id__in=failed_ids).update(attempts=F('attempts') + 1)
+
+        sent += len(sent_ids)
+        failed += len(failed_ids)
@@ -0,0 +1,174 @@
+"""
+Compiling and caching drip templates, with the Django or Jinja2
+template engine, and turning rendered HTML into plain text.
+"""
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from importlib import import_module
+
+from django.conf import settings
+from django.template import Template
+from django.utils.html import conditional_escape
+
+# handle 1.4 and back
+try:
+    from django.utils.encoding import force_text
+except ImportError:
+    from django.utils.encoding import force_unicode as force_text
+
+
+class LRUCache(object):
+    """
+    A small thread safe least-recently-used mapping.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class DjangoEngine(object):
+    """
+    Compiles sources to django.template.Template.
+    """
+
+    def compile(self, source):
+        return Template(source)
+
+
+class Jinja2Template(object):
+    """
+    Renders a Jinja2 template with the variables of a Django Context
+    (or a plain dict), so drips can render either engine the same way.
+    """
+
+    def __init__(self, template):
+        self.template = template
+
+    def render(self, context):
+        if isinstance(context, dict):
+            return self.template.render(context)
+        variables = {}
+        for d in context.dicts:
+            variables.update(d)
+        return self.template.render(variables)
+
+
+class Jinja2Engine(object):
+    """
+    Compiles sources with a Jinja2 Environment, which turns them into
+    Python code once rather than walking a node tree on every render.
+
+    The environment escapes output with Django's escaping and tolerates
+    missing attributes, so templates both engines understand render the
+    same. Point `DRIP_JINJA2_ENVIRONMENT` at a callable returning an
+    Environment to configure your own.
+    """
+
+    def __init__(self):
+        import jinja2
+
+        path = getattr(settings, 'DRIP_JINJA2_ENVIRONMENT', None)
+        if path:
+            mod_name, func_name = path.rsplit('.', 1)
+            self.environment = getattr(import_module(mod_name), func_name)()
+        else:
+            self.environment = jinja2.Environment(
+                finalize=conditional_escape,
+                undefined=getattr(jinja2, 'ChainableUndefined', jinja2.Undefined))
+
+    def compile(self, source):
+        return Jinja2Template(self.environment.from_string(source))
+
+
+ENGINES = {
+    'django': 'drip.rendering.DjangoEngine',
+    'jinja2': 'drip.rendering.Jinja2Engine',
+}
+
+_engines = {}
+
+
+def get_engine(name=None):
+    """
+    Returns the (shared) engine named by `name`, or by
+    `DRIP_TEMPLATE_ENGINE`: "django" (the default), "jinja2" or the
+    dotted path to an engine class of your own.
+    """
+    name = name or getattr(settings, 'DRIP_TEMPLATE_ENGINE', 'django')
+    try:
+        return _engines[name]
+    except KeyError:
+        mod_name, klass_name = ENGINES.get(name, name).rsplit('.', 1)
+        engine = _engines[name] = getattr(import_module(mod_name), klass_name)()
+        return engine
+
+
+#: compiled templates shared by every drip in the process, keyed by engine and source hash
+template_cache = LRUCache(getattr(settings, 'DRIP_TEMPLATE_CACHE_SIZE', 256))
+
+
+def template_key(source, engine='django'):
+    return '%s:%s' % (engine, hashlib.sha1(source.encode('utf-8')).hexdigest())
+
+
+def compile_template(source, engine=None):
+    """
+    Returns the source compiled by the named (or configured) engine,
+    compiling it only the first time it is seen.
+    """
+    engine = engine or getattr(settings, 'DRIP_TEMPLATE_ENGINE', 'django')
+    source = force_text(source)
+    key = template_key(source, engine)
+    template = template_cache.get(key)
+    if template is None:
+        template = get_engine(engine).compile(source)
+        template_cache.set(key, template)
+    return template
+
+
+#: what strip_tags() treats as a tag: <x ...>, </x>, <!...> and <?...>, quoted attributes and comments included
+TAG_RE = re.compile(r'''<(?:!--.*?--|[a-zA-Z/!?](?:[^>"']|"[^"]*"|'[^']*')*)>''', re.S)
+
+
+def has_tags(text):
+    """
+    Whether strip_tags() would change the text, stopping at the first tag.
+    """
+    return '<' in text and TAG_RE.search(text) is not None
+
+
+def html_to_text(html):
+    """
+    A faster strip_tags(): removes tags with one regular expression
+    instead of feeding the text through an HTML parser.
+    """
+    if '<' not in html:
+        return html
+    return TAG_RE.sub('', html)
@@ -1,15 +1,24 @@
+import smtplib
+import sys
 from datetime import datetime, timedelta
+from unittest import skipIf
 
+from django.template import Context
 from django.test import TestCase
 from django.test.client import RequestFactory
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import resolve, reverse
 from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend as LocmemEmailBackend
+from django.core.management import call_command
+from django.db import IntegrityError
 from django.conf import settings
+from django.test.utils import override_settings
 from django.utils import timezone
 
-from drip.models import Drip, SentDrip, QuerySetRule
+from drip.models import Drip, SentDrip, SentDripContent, DripOutbox, QuerySetRule
 from drip.drips import DripBase, DripMessage
+from drip.instrumentation import Instrumentation
 from drip.utils import get_user_model, unicode
 
 from credits.models import Profile
@@ -114,6 +123,54 @@ class DripsTestCase(TestCase):
         simple_fields = get_simple_fields(self.User)
         self.assertTrue(bool([sf for sf in simple_fields if 'profile' in sf[0]]))
 
+    def test_get_simple_fields_memoized(self):
+        from django.db.models.signals import class_prepared
+        from drip.utils import get_simple_fields, _simple_fields
+
+        simple_fields = get_simple_fields(self.User)
+        self.assertEqual(1, len(_simple_fields))
+        simple_fields[0][0] = 'changed'
+        self.assertEqual(simple_fields[1:], get_simple_fields(self.User)[1:])
+        self.assertNotEqual('changed', get_simple_fields(self.User)[0][0])
+
+        class_prepared.send(sender=Profile)
+        self.assertEqual(0, len(_simple_fields))
+
+    def test_field_index_search(self):
+        from drip.utils import FieldIndex
+
+        index = FieldIndex([['username', 'CharField'], ['profile__credits', 'PositiveIntegerField'],
+                            ['profile__user__username', 'CharField'], ['groups__name', 'CharField']])
+        self.assertEqual([['username', 'CharField'], ['profile__user__username', 'CharField']], index.search('user'))
+        self.assertEqual([['profile__user__username', 'CharField']], index.search('profile__u'))
+        self.assertEqual([['profile__credits', 'PositiveIntegerField']], index.search('cred'))
+        self.assertEqual([], index.search('redits'))
+        self.assertEqual(2, len(index.search('', limit=2)))
+
+    def test_admin_field_search(self):
+        import json
+
+        admin = self.User.objects.create(username='admin', email='admin@example.com', is_staff=True, is_superuser=True)
+        request = RequestFactory().get(reverse('admin:drip_field_search'), {'q': 'cred'})
+        request.user = admin
+        match = resolve(request.path)
+        fields = json.loads(match.func(request, *match.args, **match.kwargs).content.decode('utf-8'))
+        self.assertIn(['profile__credits', 'PositiveIntegerField'], fields)
+        self.assertTrue(all('cred' in field for field, field_type in fields))
+
+        for limit in ['many', 0, -1]:
+            request = RequestFactory().get(reverse('admin:drip_field_search'), {'q': 'cred', 'limit': limit})
+            request.user = admin
+            self.assertEqual(400, match.func(request, *match.args, **match.kwargs).status_code)
+
+        # the add form only links to it
+        admin.set_password('admin')
+        admin.save()
+        self.client.login(username='admin', password='admin')
+        response = self.client.get(reverse('admin:drip_drip_add'))
+        self.assertContains(response, 'var search_url = "%s"' % reverse('admin:drip_field_search'))
+        self.assertNotContains(response, 'profile__credits')
+
     ##################
     ### TEST DRIPS ###
     ##################
@@ -169,6 +226,111 @@ class DripsTestCase(TestCase):
         drip.prune()
         self.assertEqual(0, drip.get_queryset().count()) # everyone is pruned
 
+    def test_custom_drip_batched_sent_drips(self):
+        model_drip = self.build_joined_date_drip()
+        drip = model_drip.drip
+        drip.sent_batch_size = 1
+
+        self.assertEqual(2, drip.send())
+        self.assertEqual(2, SentDrip.objects.filter(drip=model_drip).count())
+
+        drip = Drip.objects.get(id=model_drip.id).drip
+        drip.prune()
+        self.assertEqual(0, drip.get_queryset().count()) # everyone is pruned
+
+    def test_record_sent_drips_in_chunks(self):
+        model_drip = self.build_joined_date_drip()
+        drip = model_drip.drip
+        drip.sent_batch_size = 3
+
+        message = DripMessage(drip, None)
+        sent_drips = [drip.build_sent_drip(user, message) for user in self.User.objects.all()]
+        drip.record_sent_drips(sent_drips)
+
+        self.assertEqual(20, SentDrip.objects.filter(drip=model_drip).count())
+
+    def test_templates_compiled_once(self):
+        from drip.rendering import compile_template
+
+        model_drip = self.build_joined_date_drip()
+        drip = model_drip.drip
+
+        self.assertIs(drip.get_subject_template(), drip.get_subject_template())
+        # a fresh drip with the same source shares the process-wide cache
+        self.assertIs(drip.get_subject_template(), model_drip.drip.get_subject_template())
+        self.assertIs(drip.get_body_template(), compile_template('KETTEHS ROCK!'))
+
+        drip.send()
+        for sent in SentDrip.objects.all():
+            self.assertIn(sent.user.username, sent.subject)
+
+    def test_prune_only_excludes_this_drip(self):
+        model_drip = self.build_joined_date_drip()
+        other_drip = Drip.objects.create(name='Another Drip', subject_template='Hi', body_html_template='Hi')
+
+        users = list(model_drip.drip.get_queryset())
+        SentDrip.objects.create(drip=model_drip, user=users[0], subject='', body='')
+        SentDrip.objects.create(drip=other_drip, user=users[1], subject='', body='')
+
+        drip = model_drip.drip
+        drip.prune()
+        self.assertIn('NOT EXISTS', str(drip.get_queryset().query))
+        with self.assertNumQueries(1):
+            self.assertEqual([users[1].id], list(drip.get_queryset().values_list('id', flat=True)))
+
+    def test_rerun_does_not_double_record(self):
+        model_drip = self.build_joined_date_drip()
+        self.assertEqual(2, model_drip.drip.send())
+
+        # unpruned runs, as after a crash, skip users already recorded
+        self.assertEqual(0, model_drip.drip.send())
+        drip = model_drip.drip
+        drip.sent_batch_size = 10
+        self.assertEqual(0, drip.send())
+
+        self.assertEqual(2, SentDrip.objects.filter(drip=model_drip).count())
+
+    def test_record_sent_drips_skips_duplicates(self):
+        model_drip = self.build_joined_date_drip()
+        drip = model_drip.drip
+        message = DripMessage(drip, None)
+        user = self.User.objects.all()[0]
+
+        self.assertEqual(1, drip.save_sent_drip(drip.build_sent_drip(user, message)))
+        self.assertEqual(0, drip.save_sent_drip(drip.build_sent_drip(user, message)))
+
+        sent_drips = [drip.build_sent_drip(user, message) for user in self.User.objects.all()]
+        sent_drips.append(drip.build_sent_drip(user, message))
+        self.assertEqual(19, drip.record_sent_drips(sent_drips))
+        self.assertEqual(20, SentDrip.objects.filter(drip=model_drip).count())
+
+    @override_settings(DRIP_COMPRESS_SENT_DRIPS=True)
+    def test_compressed_sent_drips(self):
+        body = '<p>%s</p>' % ('KETTEHS ROCK! ' * 50)
+        drips = [Drip.objects.create(name=name, subject_template='HELLO {{ user.username }}', body_html_template=body)
+                 for name in ['Compressed Drip', 'Another Compressed Drip']]
+
+        drip = drips[0].drip
+        drip.sent_batch_size = 3
+        self.assertEqual(20, drip.send())
+        # the same in one at a time, and shared with the first drip
+        self.assertEqual(20, drips[1].drip.send())
+
+        # a subject per user, each shared by both drips, and one body
+        self.assertEqual(21, SentDripContent.objects.count())
+        self.assertEqual(set(['']), set(SentDrip.objects.values_list('subject', flat=True)))
+        self.assertEqual(set(['']), set(SentDrip.objects.values_list('body', flat=True)))
+        content = SentDripContent.objects.get(hash=SentDripContent.hash_text(body))
+        self.assertTrue(len(content.data) < len(body) / 4)
+
+        for sent_drip in SentDrip.objects.select_related('subject_content', 'body_content').filter(drip=drips[1]):
+            self.assertEqual('HELLO %s' % sent_drip.user.username, sent_drip.subject)
+            self.assertEqual(body, sent_drip.body)
+
+        # uncompressed rows read as before
+        plain = SentDrip.objects.create(drip=drips[0], user=self.User.objects.create(username='plain'), subject='Hi', body='Yo')
+        self.assertEqual('Yo', SentDrip.objects.get(id=plain.id).body)
+
     def test_custom_short_term_drip(self):
         model_drip = self.build_joined_date_drip(shift_one=3, shift_two=4)
         drip = model_drip.drip
@@ -268,6 +430,31 @@ class DripsTestCase(TestCase):
         for count, shifted_drip in zip([4, 4, 4, 4, 4], drip.walk(into_past=3, into_future=3)):
             self.assertEqual(count, shifted_drip.get_queryset().count())
 
+    def test_timeline_matches_walk(self):
+        model_drip = self.build_joined_date_drip(shift_one=2, shift_two=4)
+        QuerySetRule.objects.create(
+            drip=model_drip,
+            field_name='groups__count',
+            lookup_type='exact',
+            field_value='0'
+        )
+        already_sent = self.User.objects.get(username='third_no_credits')
+        SentDrip.objects.create(drip=model_drip, user=already_sent, subject='Hi', body='Hi')
+
+        expected, seen_users = [], set()
+        for shifted_drip in model_drip.drip.walk(into_past=2, into_future=5):
+            shifted_drip.prune()
+            user_ids = set(shifted_drip.get_queryset().values_list('id', flat=True)) - seen_users
+            expected.append(sorted(user_ids))
+            seen_users.update(user_ids)
+
+        timeline = model_drip.drip.timeline(into_past=2, into_future=5)
+        self.assertEqual(expected, [[user.id for user in users] for shifted_drip, users in timeline])
+        self.assertEqual([-2, -1, 0, 1, 2, 3, 4],
+                         [shifted_drip.now_shift_kwargs['days'] for shifted_drip, users in timeline])
+        self.assertEqual(11, len(seen_users))
+        self.assertNotIn(already_sent.id, seen_users)
+
     def test_admin_timeline_prunes_user_output(self):
         """multiple users in timeline is confusing."""
         admin = self.User.objects.create(username='admin', email='admin@example.com')
@@ -306,6 +493,85 @@ class DripsTestCase(TestCase):
         self.assertEqual(unicode(response.content).count(admin.email), 1)
 
 
+    @override_settings(DRIP_TIMELINE_PAGE_SIZE=3)
+    def test_admin_timeline_pages_users(self):
+        import json
+
+        admin = self.User.objects.create(username='admin', email='admin@example.com', is_staff=True, is_superuser=True)
+        model_drip = self.build_joined_date_drip(shift_one=2, shift_two=4)
+        expected = [[user.id for user in users] for shifted_drip, users in model_drip.drip.timeline(into_past=2, into_future=4)]
+
+        kwargs = {'drip_id': model_drip.id, 'into_past': 2, 'into_future': 3}
+        rf = RequestFactory()
+        request = rf.get(reverse('admin:drip_timeline', kwargs=kwargs))
+        request.user = admin
+        match = resolve(request.path)
+        content = match.func(request, *match.args, **match.kwargs).content.decode('utf-8')
+
+        # counts for every day, but only the first three users inline
+        for users in expected:
+            self.assertIn('(%d user%s)' % (len(users), '' if len(users) == 1 else 's'), content)
+        self.assertEqual(3, content.count('class="view-email"'))
+
+        users_url = reverse('admin:drip_timeline_users', kwargs=kwargs)
+        for day, users in enumerate(expected):
+            paged, after = [], ''
+            while after is not None:
+                request = rf.get(users_url, {'day': day, 'after': after})
+                request.user = admin
+                match = resolve(request.path)
+                page = json.loads(match.func(request, *match.args, **match.kwargs).content.decode('utf-8'))
+                self.assertTrue(len(page['users']) <= 3)
+                paged.extend(user['id'] for user in page['users'])
+                after = page['next']
+            self.assertEqual(users, paged)
+
+        # a day nobody gets it has no next page
+        request = rf.get(users_url, {'day': 99})
+        request.user = admin
+        match = resolve(request.path)
+        page = json.loads(match.func(request, *match.args, **match.kwargs).content.decode('utf-8'))
+        self.assertEqual({'users': [], 'next': None}, page)
+
+        for query in [{'day': 'today'}, {'day': 0, 'limit': 0}, {'day': 0, 'limit': -1}]:
+            request = rf.get(users_url, query)
+            request.user = admin
+            match = resolve(request.path)
+            self.assertEqual(400, match.func(request, *match.args, **match.kwargs).status_code)
+
+    def test_view_drip_email_caches_previews(self):
+        from django.core.cache import cache
+
+        cache.clear()
+        admin = self.User.objects.create(username='admin', email='admin@example.com', is_staff=True, is_superuser=True)
+        model_drip = self.build_joined_date_drip(shift_one=2, shift_two=4)
+        user = self.User.objects.get(username='first_no_credits')
+        rf = RequestFactory()
+
+        def view(name, **kwargs):
+            kwargs.update({'drip_id': model_drip.id, 'into_past': 2, 'into_future': 3})
+            request = rf.get(reverse(name, kwargs=kwargs))
+            request.user = admin
+            match = resolve(request.path)
+            return match.func(request, *match.args, **match.kwargs)
+
+        self.assertIn(b'KETTEHS ROCK!', view('admin:view_drip_email', user_id=user.id).content)
+        # cached: only the drip is fetched
+        with self.assertNumQueries(1):
+            self.assertIn(b'KETTEHS ROCK!', view('admin:view_drip_email', user_id=user.id).content)
+
+        # editing the drip leaves the old preview behind
+        model_drip.body_html_template = 'KETTEHS STILL ROCK!'
+        model_drip.save()
+        self.assertIn(b'KETTEHS STILL ROCK!', view('admin:view_drip_email', user_id=user.id).content)
+
+        # opening the timeline renders previews of the first users up front
+        cache.clear()
+        view('admin:drip_timeline')
+        shown = [u for shifted_drip, users in model_drip.drip.timeline(into_past=2, into_future=4) for u in users]
+        with self.assertNumQueries(1):
+            self.assertIn(b'KETTEHS STILL ROCK!', view('admin:view_drip_email', user_id=shown[-1].id).content)
+
     ##################
     ### TEST M2M   ###
     ##################
@@ -419,6 +685,42 @@ class PlainDripEmail(DripMessage):
         return self._message
 
 
+# Used by CustomMessagesTest
+class PickyDripEmail(DripMessage):
+    @property
+    def subject(self):
+        if self.user.username == 'picky':
+            raise ValueError('no subject for you')
+        return super(PickyDripEmail, self).subject
+
+
+# Used by DeliveryTest
+class WebhookMessage(object):
+    sent = []
+
+    def __init__(self, user):
+        self.user = user
+
+    def send(self):
+        self.sent.append(self.user)
+        return 1
+
+
+class WebhookDripMessage(DripMessage):
+    @property
+    def message(self):
+        return WebhookMessage(self.user)
+
+
+# Used by CustomMessagesTest
+class SiteDripEmail(DripMessage):
+    @property
+    def context(self):
+        if not self._context:
+            self._context = Context({'user': self.user, 'site': 'EXAMPLE'})
+        return self._context
+
+
 class CustomMessagesTest(TestCase):
     def setUp(self):
         self.User = get_user_model()
@@ -478,3 +780,682 @@ class CustomMessagesTest(TestCase):
         self.assertEqual(1, len(mail.outbox))
         email = mail.outbox.pop()
         self.assertIsInstance(email, mail.EmailMessage)
+
+    def test_html_to_text(self):
+        from drip.rendering import has_tags, html_to_text
+
+        # what strip_tags() gives from Django 1.7 on, older versions strip any <...>
+        for html, text in [
+                ('KETTEHS ROCK!', 'KETTEHS ROCK!'),
+                ('<h2>This</h2> is an <b>example</b> html <strong>body</strong>.', 'This is an example html body.'),
+                ('a < b and c > d', 'a < b and c > d'),
+                ('<p>a < b</p>', 'a < b'),
+                ('<a href="x>y">link</a>', 'link'),
+                ("<img alt='>'/>ok", 'ok'),
+                ('<!-- comment -->text', 'text'),
+                ('&amp; &lt;b&gt;', '&amp; &lt;b&gt;'),
+                ('<br/>line<br>', 'line'),
+                ('x <3 y', 'x <3 y'),
+                ('tail <b', 'tail <b'),
+                ('<!DOCTYPE html><html><body>B</body></html>', 'B'),
+                ('1<2>3', '1<2>3'),
+                ('< p>space</p>', '< p>space')]:
+            self.assertEqual(text, html_to_text(html), html)
+            self.assertEqual(text != html, has_tags(html), html)
+
+    def test_escaped_values_stay_plain(self):
+        self.model_drip.body_html_template = 'Hi {{ user.username }} & welcome'
+        self.model_drip.save()
+        self.User.objects.filter(id=self.user.id).update(username='<b>bold</b>')
+
+        self.assertEqual(1, self.model_drip.drip.send())
+        email = mail.outbox.pop()
+        self.assertEqual('Hi &lt;b&gt;bold&lt;/b&gt; & welcome', email.body)
+        self.assertEqual([], email.alternatives)
+
+    def test_safe_values_keep_their_tags(self):
+        from django.utils.safestring import mark_safe
+
+        self.model_drip.body_html_template = 'Hi {{ user.sig }}'
+        self.model_drip.save()
+        drip_base = self.model_drip.drip
+
+        self.user.sig = mark_safe('<b>bold</b>')
+        message_instance = DripMessage(drip_base, self.user)
+        self.assertEqual('Hi bold', message_instance.plain)
+        self.assertEqual('Hi bold', message_instance.message.body)
+        self.assertEqual([('Hi <b>bold</b>', 'text/html')], message_instance.message.alternatives)
+
+    def test_render_many(self):
+        users = [self.user, self.User.objects.create(username='picky', email='picky@example.com'),
+                 self.User.objects.create(username='other', email='other@example.com')]
+        drip_base = self.model_drip.drip
+
+        message_instances = PickyDripEmail.render_many(drip_base, users)
+        self.assertEqual([self.user, users[2]], [message_instance.user for message_instance in message_instances])
+        self.assertEqual(['HELLO customuser', 'HELLO other'], [m.subject for m in message_instances])
+        self.assertEqual('This is an example html body.', message_instances[1].plain)
+        self.assertIsInstance(message_instances[0].message, mail.EmailMultiAlternatives)
+
+        # the shared context was only lent out while rendering
+        self.assertEqual(None, message_instances[0]._context)
+        self.assertEqual('other', message_instances[1].context['user'].username)
+        self.assertFalse(hasattr(DripMessage(drip_base, self.user), '__dict__'))
+
+    def test_render_many_custom_context(self):
+        self.model_drip.subject_template = 'Hi {{ site }}'
+        self.model_drip.save()
+
+        message_instances = SiteDripEmail.render_many(self.model_drip.drip, [self.user])
+        self.assertEqual('Hi EXAMPLE', message_instances[0].subject)
+
+
+# Used by DeliveryTest
+class CountingEmailBackend(LocmemEmailBackend):
+    opened = 0
+
+    def open(self):
+        CountingEmailBackend.opened += 1
+
+
+# Used by DeliveryTest
+class RefusingEmailBackend(LocmemEmailBackend):
+    def send_messages(self, messages):
+        if any('user_0' in message.to[0] for message in messages):
+            raise smtplib.SMTPSenderRefused(421, 'slow down', 'from@example.com')
+        return super(RefusingEmailBackend, self).send_messages(messages)
+
+
+@override_settings(EMAIL_BACKEND='drip.tests.CountingEmailBackend')
+class DeliveryTest(TestCase):
+    def setUp(self):
+        self.User = get_user_model()
+        CountingEmailBackend.opened = 0
+
+        for i in range(5):
+            self.User.objects.create(username='user_%d' % i, email='user_%d@example.com' % i)
+
+        for name in ['First Drip', 'Second Drip']:
+            Drip.objects.create(
+                name=name,
+                enabled=True,
+                subject_template='HELLO {{ user.username }}',
+                body_html_template='KETTEHS ROCK!'
+            )
+
+    def test_send_opens_one_connection(self):
+        drip = Drip.objects.get(name='First Drip').drip
+        drip.send_batch_size = 2
+
+        self.assertEqual(5, drip.send())
+        self.assertEqual(5, len(mail.outbox))
+        self.assertEqual(1, CountingEmailBackend.opened)
+
+    def test_send_drips_shares_connection(self):
+        call_command('send_drips')
+
+        self.assertEqual(10, len(mail.outbox))
+        self.assertEqual(10, SentDrip.objects.count())
+        self.assertEqual(1, CountingEmailBackend.opened)
+
+    @override_settings(DRIP_SEND_BATCH_SIZE=50, DRIP_STREAM_USERS=False, DRIP_USE_OUTBOX=True,
+                       DRIP_SENT_BATCH_SIZE=500, DRIP_COMPRESS_SENT_DRIPS=True)
+    def test_class_attributes_beat_settings(self):
+        class TunedDrip(DripBase):
+            send_batch_size = 2
+            stream_users = True
+            use_outbox = False
+            sent_batch_size = 10
+            compress_sent_drips = False
+
+        model_drip = Drip.objects.get(name='First Drip')
+        drip = TunedDrip(model_drip, name='Tuned Drip')
+        self.assertEqual((2, True, False, 10, False),
+                         (drip.send_batch_size, drip.stream_users, drip.use_outbox,
+                          drip.sent_batch_size, drip.compress_sent_drips))
+
+        drip = TunedDrip(model_drip, name='Tuned Drip', send_batch_size=3, use_outbox=True)
+        self.assertEqual((3, True), (drip.send_batch_size, drip.use_outbox))
+
+        drip = DripBase(model_drip, name='Plain Drip')
+        self.assertEqual((50, False, True, 500, True),
+                         (drip.send_batch_size, drip.stream_users, drip.use_outbox,
+                          drip.sent_batch_size, drip.compress_sent_drips))
+
+    def test_send_records_buffered_drips_on_failure(self):
+        from drip.delivery import SerialDelivery
+
+        class FailingDelivery(SerialDelivery):
+            batches = 0
+
+            def deliver(self, message_instances):
+                self.batches += 1
+                if self.batches == 3:
+                    raise RuntimeError('relay went away')
+                return super(FailingDelivery, self).deliver(message_instances)
+
+        drip = Drip.objects.get(name='First Drip').drip
+        drip.send_batch_size = 2
+        drip.sent_batch_size = 100
+
+        with FailingDelivery() as delivery:
+            self.assertRaises(RuntimeError, drip.send, delivery=delivery)
+
+        self.assertEqual(4, len(mail.outbox))
+        self.assertEqual(4, SentDrip.objects.filter(drip=drip.drip_model).count())
+
+    def test_send_streams_users(self):
+        drip = Drip.objects.get(name='First Drip').drip
+        drip.stream_users = True
+        drip.send_batch_size = 2
+
+        batches = list(drip.iter_user_batches())
+        self.assertEqual([2, 2, 1], [len(batch) for batch in batches])
+        user_ids = [user.id for batch in batches for user in batch]
+        self.assertEqual(sorted(user_ids), user_ids)
+
+        # one query per page
+        with self.assertNumQueries(3):
+            self.assertEqual(3, len(list(drip.iter_user_batches())))
+
+        self.assertEqual(5, drip.send())
+        self.assertEqual(5, len(mail.outbox))
+
+    @override_settings(DRIP_USE_OUTBOX=True)
+    def test_outbox_run_then_drain(self):
+        drip = Drip.objects.get(name='First Drip')
+
+        self.assertEqual(5, drip.drip.run())
+        self.assertEqual(0, len(mail.outbox))
+        self.assertEqual(5, DripOutbox.objects.filter(drip=drip).count())
+
+        # queued users are pruned from the next run
+        self.assertEqual(0, drip.drip.run())
+
+        from django.utils.six import StringIO
+        out = StringIO()
+        call_command('drain_drip_outbox', workers=2, batch_size=2, stdout=out)
+        self.assertIn('Sent 5, failed 0', out.getvalue())
+
+        self.assertEqual(5, len(mail.outbox))
+        self.assertEqual(5, SentDrip.objects.filter(drip=drip).count())
+        self.assertEqual(0, DripOutbox.objects.count())
+        for sent in SentDrip.objects.all():
+            self.assertEqual('HELLO %s' % sent.user.username, sent.subject)
+
+    @override_settings(DRIP_USE_OUTBOX=True)
+    def test_drain_keeps_rows_it_could_not_record(self):
+        from drip.delivery import SerialDelivery
+        from drip.outbox import drain
+
+        Drip.objects.get(name='First Drip').drip.run()
+
+        def insert_sent_drips(self, chunk):
+            raise IntegrityError('no room')
+
+        original = DripBase.insert_sent_drips
+        DripBase.insert_sent_drips = insert_sent_drips
+        try:
+            with SerialDelivery() as delivery:
+                self.assertRaises(IntegrityError, drain, delivery)
+        finally:
+            DripBase.insert_sent_drips = original
+
+        self.assertEqual(0, SentDrip.objects.count())
+        self.assertEqual(5, DripOutbox.objects.filter(sent_at__isnull=False).count())
+        self.assertEqual(5, len(mail.outbox))
+
+        # once their claim times out they are recorded, not sent again
+        with SerialDelivery() as delivery:
+            self.assertEqual((5, 0), drain(delivery, claim_timeout=-1))
+        self.assertEqual(5, SentDrip.objects.count())
+        self.assertEqual(0, DripOutbox.objects.count())
+        self.assertEqual(5, len(mail.outbox))
+
+    @override_settings(DRIP_USE_OUTBOX=True)
+    def test_outbox_claims(self):
+        from drip.outbox import claim
+
+        Drip.objects.get(name='First Drip').drip.run()
+
+        first = claim(batch_size=3)
+        second = claim(batch_size=3)
+        self.assertEqual(3, len(first))
+        self.assertEqual(2, len(second))
+        self.assertFalse(set(row.id for row in first) & set(row.id for row in second))
+        self.assertEqual([], claim())
+
+        # stale claims from a dead drainer are picked up again
+        self.assertEqual(5, len(claim(batch_size=10, claim_timeout=-1)))
+
+    def test_threaded_delivery(self):
+        from drip.delivery import ThreadedDelivery
+
+        drip = Drip.objects.get(name='First Drip').drip
+        drip.send_batch_size = 2
+
+        with ThreadedDelivery(workers=3) as delivery:
+            self.assertEqual(5, drip.send(delivery=delivery))
+
+        self.assertEqual(5, len(mail.outbox))
+        self.assertEqual(5, SentDrip.objects.filter(drip=drip.drip_model).count())
+        self.assertEqual(3, CountingEmailBackend.opened) # one connection per worker
+
+    def test_threaded_delivery_must_be_opened(self):
+        from drip.delivery import ThreadedDelivery
+
+        drip = Drip.objects.get(name='First Drip').drip
+        self.assertRaises(RuntimeError, drip.send, delivery=ThreadedDelivery(workers=3))
+        self.assertEqual(0, len(mail.outbox))
+        self.assertEqual(0, SentDrip.objects.count())
+
+    def test_aimd_controller(self):
+        from drip.delivery import AIMDController
+
+        now = [0]
+        controller = AIMDController(10, initial=2, target_latency=1.0, clock=lambda: now[0])
+        for i in range(10):
+            controller.record(0.1, True)
+        self.assertEqual(4, controller.limit) # about one more per window of sends
+
+        controller.record(0.1, False)
+        self.assertEqual(2, controller.limit)
+        controller.record(5.0, True) # too slow, but within the same congestion event
+        self.assertEqual(2, controller.limit)
+
+        now[0] = 2
+        controller.record(5.0, True)
+        self.assertEqual(1, controller.limit)
+        controller.record(0.1, False)
+        self.assertEqual(1, controller.limit) # never below the minimum
+
+        for i in range(1000):
+            controller.record(0.1, True)
+        self.assertEqual(10, controller.limit) # nor above the maximum
+
+    @override_settings(EMAIL_BACKEND='drip.tests.RefusingEmailBackend')
+    def test_threaded_delivery_backs_off(self):
+        from drip.delivery import ThreadedDelivery, AIMDController
+
+        controller = AIMDController(4, initial=4)
+        with ThreadedDelivery(workers=4, controller=controller) as delivery:
+            self.assertEqual(4, Drip.objects.get(name='First Drip').drip.send(delivery=delivery))
+
+        self.assertEqual(4, len(mail.outbox))
+        self.assertTrue(controller.limit < 4)
+
+    @override_settings(DRIP_SEND_ADAPTIVE={'target_latency': 5})
+    def test_get_delivery_adaptive(self):
+        from drip.delivery import get_delivery
+
+        delivery = get_delivery(workers=3)
+        self.assertEqual(3, delivery.controller.maximum)
+        self.assertEqual(5, delivery.controller.target_latency)
+        self.assertEqual(None, get_delivery(workers=1).__dict__.get('controller'))
+
+    def test_send_drips_with_workers(self):
+        call_command('send_drips', workers=2)
+
+        self.assertEqual(10, len(mail.outbox))
+        self.assertEqual(10, SentDrip.objects.count())
+        self.assertEqual(2, CountingEmailBackend.opened)
+
+    def test_send_drips_dry_run_benchmark(self):
+        from django.utils.six import StringIO
+
+        out = StringIO()
+        call_command('send_drips', dry_run=True, benchmark=True, stdout=out)
+
+        self.assertEqual(0, len(mail.outbox))
+        self.assertEqual(0, SentDrip.objects.count())
+        for drip in Drip.objects.all():
+            self.assertIn('Drip %s (%s): 5 candidates, 5 to send' % (drip.id, drip.name), out.getvalue())
+        for stage in ['query', 'prune', 'render', 'strip_tags', 'message', 'send', 'record']:
+            self.assertIn(' %s ' % stage, out.getvalue())
+
+    @override_settings(DRIP_MESSAGE_CLASSES={'webhook': 'drip.tests.WebhookDripMessage'})
+    def test_dry_run_never_sends_custom_messages(self):
+        from django.utils.six import StringIO
+
+        WebhookMessage.sent = []
+        Drip.objects.update(message_class='webhook')
+        call_command('send_drips', dry_run=True, benchmark=True, stdout=StringIO())
+
+        self.assertEqual([], WebhookMessage.sent)
+        self.assertEqual(0, SentDrip.objects.count())
+
+    def test_send_drips_largest_first(self):
+        from drip.management.commands.send_drips import Command
+
+        small = Drip.objects.get(name='First Drip')
+        QuerySetRule.objects.create(drip=small, field_name='username', lookup_type='exact', field_value='user_0')
+        large = Drip.objects.get(name='Second Drip')
+
+        self.assertEqual([(large.id, 5), (small.id, 1)], Command().audience_sizes())
+
+    def test_send_drips_run_drip(self):
+        from drip.management.commands.send_drips import run_drip
+
+        drip = Drip.objects.get(name='First Drip')
+        self.assertEqual((drip.id, 5, None), run_drip((drip.id, None, None)))
+        self.assertEqual(5, len(mail.outbox))
+
+        drip_id, count, error = run_drip((0, None, None))
+        self.assertEqual(None, count)
+        self.assertIn('DoesNotExist', error)
+
+    def test_send_drips_with_processes(self):
+        from django.utils.six import StringIO
+
+        out = StringIO()
+        call_command('send_drips', processes=2, stdout=out)
+
+        for drip in Drip.objects.all():
+            self.assertIn('Drip %s sent 5' % drip.id, out.getvalue())
+
+
+# Used by InstrumentationTest
+class RecordingInstrumentation(Instrumentation):
+    events = []
+
+    def timing(self, event, seconds, drip_id=None, drip_name=None):
+        self.events.append(('timing', event, drip_id, drip_name))
+
+    def count(self, event, value, drip_id=None, drip_name=None):
+        self.events.append(('count', event, value, drip_id, drip_name))
+
+
+@override_settings(DRIP_INSTRUMENTATION='drip.tests.RecordingInstrumentation')
+class InstrumentationTest(TestCase):
+    def setUp(self):
+        RecordingInstrumentation.events = []
+        self.User = get_user_model()
+        for i in range(3):
+            self.User.objects.create(username='user_%d' % i, email='user_%d@example.com' % i)
+        self.model_drip = Drip.objects.create(
+            name='Instrumented Drip',
+            enabled=True,
+            subject_template='HELLO {{ user.username }}',
+            body_html_template='KETTEHS ROCK!'
+        )
+        QuerySetRule.objects.create(
+            drip=self.model_drip,
+            field_name='username',
+            lookup_type='startswith',
+            field_value='user_'
+        )
+
+    def test_events_for_each_stage(self):
+        self.assertEqual(3, self.model_drip.drip.run())
+
+        events = RecordingInstrumentation.events
+        timed = set(event[1] for event in events if event[0] == 'timing')
+        self.assertEqual(set(['rules', 'prune', 'query', 'render', 'send', 'record']), timed)
+        for event in events:
+            self.assertEqual((self.model_drip.id, 'Instrumented Drip'), event[-2:])
+
+        counts = {}
+        for event in events:
+            if event[0] == 'count':
+                counts[event[1]] = counts.get(event[1], 0) + event[2]
+        self.assertEqual({'rules': 1, 'sent': 3, 'failed': 0, 'recorded': 3}, counts)
+
+    def test_statsd_packets(self):
+        from drip.instrumentation import StatsdInstrumentation
+
+        statsd = StatsdInstrumentation(prefix='app', tags=False)
+        self.assertEqual('app.7.send:250|ms', statsd.packet('send', 250, 'ms', 7, 'Welcome'))
+        statsd.tags = True
+        self.assertEqual('app.sent:3|c|#drip_id:7,drip_name:Welcome', statsd.packet('sent', 3, 'c', 7, 'Welcome'))
+        # fire and forget, even with nobody listening
+        statsd.timing('send', 0.25, drip_id=7, drip_name='Welcome')
+
+
+@override_settings(DRIP_SEND_BATCH_SIZE=10, DRIP_SENT_BATCH_SIZE=10,
+                   EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class QueryBudgetTest(TestCase):
+    """
+    The queries a drip runs may grow with the number of chunks it works
+    through, never with the number of users in them. Each stage is run
+    against two audience sizes to catch per-user queries sneaking in.
+    """
+    chunk = 10
+
+    def setUp(self):
+        self.User = get_user_model()
+        self.model_drip = Drip.objects.create(
+            name='Budget Drip',
+            enabled=True,
+            subject_template='HELLO {{ user.username }}',
+            body_html_template='<p>Hi {{ user.email }}, KETTEHS ROCK!</p>'
+        )
+        QuerySetRule.objects.create(
+            drip=self.model_drip,
+            field_name='username',
+            lookup_type='startswith',
+            field_value='user_'
+        )
+        QuerySetRule.objects.create(
+            drip=self.model_drip,
+            method_type='exclude',
+            field_name='email',
+            lookup_type='endswith',
+            field_value='@example.org'
+        )
+
+    def set_audience(self, size):
+        existing = self.User.objects.count()
+        for i in range(existing, size):
+            self.User.objects.create(username='user_%d' % i, email='user_%d@example.com' % i)
+        SentDrip.objects.all().delete()
+        mail.outbox = []
+
+    def queries(self, func):
+        from drip.benchmark import count_queries
+
+        counts = []
+        with count_queries(counts):
+            func()
+        return counts[0]
+
+    def assertQueryBudget(self, stage, fixed, per_chunk=0):
+        """
+        Run stage(drip_base), which returns how many users it handled,
+        for audiences of two and four chunks and check it stays within
+        `fixed` plus `per_chunk` queries per chunk.
+        """
+        counts = []
+        for size in (2 * self.chunk, 4 * self.chunk):
+            self.set_audience(size)
+            chunks = size // self.chunk
+            handled = []
+            count = self.queries(lambda: handled.append(stage(self.model_drip.drip)))
+            self.assertEqual([size], handled)
+            self.assertLessEqual(count, fixed + per_chunk * chunks,
+                '%d queries for %d users in %d chunks' % (count, size, chunks))
+            counts.append(count)
+        self.assertLessEqual(counts[1] - counts[0], 2 * per_chunk,
+            '%d more queries for %d more users' % (counts[1] - counts[0], 2 * self.chunk))
+
+    def test_apply_queryset_rules_budget(self):
+        # the rules, then the users
+        self.assertQueryBudget(lambda drip_base: len(drip_base.get_queryset()), 2)
+
+    def test_prune_budget(self):
+        def prune(drip_base):
+            drip_base.prune()
+            return len(drip_base.get_queryset())
+        self.assertQueryBudget(prune, 2)
+
+    def test_send_budget(self):
+        # the rules and the users, then checking and inserting SentDrips per chunk
+        self.assertQueryBudget(lambda drip_base: drip_base.run(), 2, per_chunk=4)
+
+    def test_timeline_budget(self):
+        from drip.benchmark import timeline_view
+
+        def timeline(drip_base):
+            return timeline_view(self.model_drip, 2, 2).content.count(b'class="view-email"')
+        # the drip, its rules, then every day's count and the first page at once
+        self.assertQueryBudget(timeline, 4)
+
+    def test_walk_shares_rules(self):
+        self.set_audience(self.chunk)
+        drip_base = self.model_drip.drip
+
+        def walk():
+            for shifted_drip in drip_base.walk(into_past=3, into_future=4):
+                shifted_drip.get_queryset()
+        self.assertEqual(1, self.queries(walk))
+
+    def test_send_drips_prefetches_rules(self):
+        from drip.management.commands.send_drips import enabled_drips
+
+        other_drip = Drip.objects.create(name='Other Budget Drip', enabled=True)
+        QuerySetRule.objects.create(drip=other_drip, field_name='username', lookup_type='startswith', field_value='x')
+
+        drips = list(enabled_drips())
+        self.assertEqual(0, self.queries(lambda: [drip.drip.get_queryset() for drip in drips]))
+
+
+try:
+    import jinja2
+except ImportError:
+    jinja2 = None
+
+
+@skipIf(jinja2 is None, 'Jinja2 is not installed')
+class TemplateEngineTest(TestCase):
+    # templates in the syntax both engines share
+    templates = [
+        'HELLO {{ user.username }}',
+        '<h1>Hi {{ user.username }}!</h1><p>{{ user.email }}</p>',
+        '{% if user.email %}Mail {{ user.email }}{% else %}No mail{% endif %}',
+        '<ul>{% for i in "123" %}<li>Tip {{ i }}</li>{% endfor %}</ul>',
+        'You have {{ user.profile.credits }} credits{{ user.missing }}{{ user.missing.deeper }}.',
+    ]
+
+    def setUp(self):
+        self.User = get_user_model()
+        self.users = [
+            self.User.objects.create(username='plain', email='plain@example.com'),
+            self.User.objects.create(username='<b>bold</b> & "quoted"', email=''),
+        ]
+        self.model_drip = Drip.objects.create(
+            name='Engine Drip',
+            enabled=True,
+            subject_template='HELLO {{ user.username }}',
+            body_html_template=self.templates[1]
+        )
+
+    def test_templates_render_the_same(self):
+        from django.template import Context
+        from drip.rendering import compile_template
+
+        for source in self.templates:
+            for user in self.users:
+                context = Context({'user': user})
+                self.assertEqual(compile_template(source, 'django').render(context),
+                                 compile_template(source, 'jinja2').render(context), source)
+
+    def test_drip_engine(self):
+        from drip.rendering import Jinja2Template
+
+        drip_base = self.model_drip.drip
+        self.assertEqual(None, drip_base.template_engine)
+        django_bodies = [m.body for m in DripMessage.render_many(drip_base, self.users)]
+
+        with self.settings(DRIP_TEMPLATE_ENGINE='jinja2'):
+            drip_base = self.model_drip.drip
+            self.assertIsInstance(drip_base.get_body_template(), Jinja2Template)
+            self.assertEqual(django_bodies, [m.body for m in DripMessage.render_many(drip_base, self.users)])
+
+        drip_base = DripBase(self.model_drip, name='Engine Drip', template_engine='jinja2',
+                             body_template=self.templates[1])
+        self.assertIsInstance(drip_base.get_body_template(), Jinja2Template)
+        self.assertEqual(django_bodies, [m.body for m in DripMessage.render_many(drip_base, self.users)])
+
+    @override_settings(DRIP_TEMPLATE_ENGINE='jinja2')
+    def test_send_with_jinja2(self):
+        self.assertEqual(2, self.model_drip.drip.send())
+        self.assertEqual(['HELLO plain'], [email.subject for email in mail.outbox if email.to == ['plain@example.com']])
+
+
+@skipIf(sys.version_info < (3, 5), 'asyncio delivery needs Python 3.5+')
+class AsyncDeliveryTest(TestCase):
+    def setUp(self):
+        self.User = get_user_model()
+        for i in range(6):
+            self.User.objects.create(username='user_%d' % i, email='user_%d@example.com' % i)
+        self.model_drip = Drip.objects.create(
+            name='Async Drip',
+            enabled=True,
+            subject_template='HELLO {{ user.username }}',
+            body_html_template='KETTEHS ROCK!'
+        )
+
+    def test_bounded_concurrency(self):
+        from drip.aio import AsyncDelivery, LocmemAsyncBackend
+
+        backend = LocmemAsyncBackend(latency=0.01, fail_for=['user_0@example.com'])
+        with AsyncDelivery(backend=backend, concurrency=2) as delivery:
+            self.assertEqual(5, self.model_drip.drip.send(delivery=delivery))
+
+        self.assertEqual(5, len(mail.outbox))
+        self.assertEqual(2, backend.max_in_flight)
+        self.assertFalse(SentDrip.objects.filter(user__email='user_0@example.com').exists())
+
+    def test_adaptive_concurrency(self):
+        from drip.aio import AsyncDelivery, LocmemAsyncBackend
+        from drip.delivery import AIMDController
+
+        backend = LocmemAsyncBackend(latency=0.01)
+        controller = AIMDController(4, initial=1, target_latency=0.001)
+        with AsyncDelivery(backend=backend, concurrency=4, controller=controller) as delivery:
+            self.assertEqual(6, self.model_drip.drip.send(delivery=delivery))
+
+        # every send was slower than the target, so only one was ever in flight
+        self.assertEqual(1, backend.max_in_flight)
+
+    @override_settings(DRIP_ASYNC_EMAIL_BACKEND='drip.aio.ExecutorBackend')
+    def test_send_drips_asyncio_engine(self):
+        call_command('send_drips', engine='asyncio', workers=3)
+
+        self.assertEqual(6, len(mail.outbox))
+        self.assertEqual(6, SentDrip.objects.count())
+
+    @override_settings(DRIP_ASYNC_EMAIL_BACKEND='drip.aio.ExecutorBackend')
+    def test_executor_sized_from_concurrency(self):
+        from drip.delivery import get_delivery
+
+        with get_delivery(engine='asyncio', workers=25) as delivery:
+            self.assertEqual(25, delivery.backend.max_workers)
+            self.assertEqual(25, delivery.backend._executor._max_workers)
+            self.assertEqual(6, self.model_drip.drip.send(delivery=delivery))
+
+
+class ScaleBenchmarkTest(TestCase):
+    def test_small_scale_benchmark(self):
+        from drip.benchmark import generate_fixture, run_scale_benchmark
+
+        drip = generate_fixture(users=60, history=0.5, history_drips=2, batch_size=25)
+        User = get_user_model()
+        self.assertEqual(60, User.objects.count())
+        self.assertEqual(90, SentDrip.objects.count())
+
+        results = run_scale_benchmark(drip, into_past=1, into_future=1)
+        self.assertEqual(['prune', 'walk', 'timeline', 'run'], [result['stage'] for result in results])
+        results = dict((result['stage'], result) for result in results)
+        # 14 of the 60 users joined one to three weeks ago, half of those already got it
+        self.assertEqual(7, results['prune']['items'])
+        self.assertEqual(7, results['run']['items'])
+        self.assertTrue(results['run']['queries'] > 0)
+
+    @override_settings(DRIP_TIMELINE_PAGE_SIZE=1)
+    def test_timeline_counts_past_first_page(self):
+        from drip.benchmark import generate_fixture, run_scale_benchmark
+
+        drip = generate_fixture(users=60, history=0.5, history_drips=0, batch_size=25)
+        results = dict((result['stage'], result) for result in run_scale_benchmark(drip, into_past=1, into_future=1))
+        # every user first getting it on each of the four days, though only one a day is listed
+        self.assertEqual(8, results['timeline']['items'])
@@ -1,6 +1,9 @@
+import bisect
 import sys
+import threading
 
 from django.db import models
+from django.db.models.signals import class_prepared
 from django.db.models import ForeignKey, OneToOneField, ManyToManyField
 from django.db.models.related import RelatedObject
 
@@ -110,8 +113,80 @@ def give_model_field(full_field, Model):
 
     raise Exception('Field key `{0}` not found on `{1}`.'.format(full_field, Model.__name__))
 
+_simple_fields = {}
+_simple_fields_lock = threading.Lock()
+
+
 def get_simple_fields(Model, **kwargs):
-    return [[f[0], f[3].__name__] for f in get_fields(Model, **kwargs)]
+    """
+    Returns [full field name, field class name] for every field from
+    get_fields(). Walking the relations is slow, so the result is kept
+    per model and arguments until any model class is (re)defined.
+    """
+    key = (Model, repr(sorted(kwargs.items())))
+    with _simple_fields_lock:
+        simple_fields = _simple_fields.get(key)
+    if simple_fields is None:
+        simple_fields = [[f[0], f[3].__name__] for f in get_fields(Model, **kwargs)]
+        with _simple_fields_lock:
+            _simple_fields[key] = simple_fields
+    return [list(f) for f in simple_fields]
+
+
+class FieldIndex(object):
+    """
+    A sorted index of the fields from get_simple_fields(), for finding
+    the ones with any part of their name starting with a prefix.
+
+    Every field is indexed under each part of its name onwards, so
+    "profile__user__email" is found by "prof", "user__em" and "email".
+    """
+
+    def __init__(self, simple_fields):
+        self.fields = simple_fields
+        keys = []
+        for i, (full_field, field_type) in enumerate(simple_fields):
+            parts = full_field.split('__')
+            for start in range(len(parts)):
+                keys.append(('__'.join(parts[start:]), i))
+        keys.sort()
+        self.keys = keys
+
+    def search(self, prefix, limit=None):
+        """
+        Returns [full field name, field class name] for the matching
+        fields, in get_fields() order.
+        """
+        matches = set()
+        for position in range(bisect.bisect_left(self.keys, (prefix,)), len(self.keys)):
+            key, i = self.keys[position]
+            if not key.startswith(prefix):
+                break
+            matches.add(i)
+        return [list(self.fields[i]) for i in sorted(matches)[:limit]]
+
+
+_field_indexes = {}
+
+
+def get_field_index(Model):
+    """
+    Returns the FieldIndex for the model, kept like get_simple_fields().
+    """
+    with _simple_fields_lock:
+        field_index = _field_indexes.get(Model)
+    if field_index is None:
+        field_index = FieldIndex(get_simple_fields(Model))
+        with _simple_fields_lock:
+            _field_indexes[Model] = field_index
+    return field_index
+
+
+def clear_simple_fields(**kwargs):
+    with _simple_fields_lock:
+        _simple_fields.clear()
+        _field_indexes.clear()
+class_prepared.connect(clear_simple_fields, dispatch_uid='drip_clear_simple_fields')
 
 def get_user_model():
     # handle 1.7 and back